@@ -0,0 +1,95 @@
+import gzip
+import io
+import os
+from typing import BinaryIO, Optional
+
+try:
+    import zstandard
+except ImportError:  # 選用套件，沒有安裝時只能使用 gzip
+    zstandard = None
+
+# 備份壓縮方式：none / gzip / zstd（zstd 需要 zstandard 套件）
+BACKUP_COMPRESSION = os.getenv("BACKUP_COMPRESSION", "none").lower()
+GZIP_LEVEL = int(os.getenv("BACKUP_GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("BACKUP_ZSTD_LEVEL", "3"))
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def resolve(method: Optional[str] = None) -> str:
+    """確認壓縮方式可用；設定 zstd 但沒有安裝 zstandard 時改用 gzip"""
+    method = (method or BACKUP_COMPRESSION).lower()
+    if method not in SUFFIXES:
+        print(f"未知的壓縮方式 {method}，改為不壓縮")
+        return "none"
+    if method == "zstd" and zstandard is None:
+        print("未安裝 zstandard，備份改用 gzip 壓縮")
+        return "gzip"
+    return method
+
+
+def suffix(method: str) -> str:
+    return SUFFIXES[method]
+
+
+def strip_suffix(filename: str) -> str:
+    """去掉壓縮副檔名，例如 chat_log_1.jsonl.gz -> chat_log_1.jsonl"""
+    for ext in (".gz", ".zst"):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def detect(path: str) -> str:
+    """依檔頭判斷壓縮方式，副檔名只作為空檔案時的參考"""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head == ZSTD_MAGIC:
+        return "zstd"
+    if not head:
+        if path.endswith(".gz"):
+            return "gzip"
+        if path.endswith(".zst"):
+            return "zstd"
+    return "none"
+
+
+def open_read(path: str) -> BinaryIO:
+    """以串流方式讀取（自動解壓）；可以逐行迭代"""
+    method = detect(path)
+    if method == "gzip":
+        return gzip.open(path, "rb")
+    if method == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{os.path.basename(path)} 是 zstd 壓縮檔，需要安裝 zstandard")
+        raw = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return open(path, "rb")
+
+
+def open_write(path: str, method: str, append: bool = False) -> BinaryIO:
+    """以串流方式寫入
+
+    append 時 gzip 追加一個新的 member、zstd 追加一個新的 frame；
+    讀取端會把多個 member / frame 接起來，適合只追加的 JSONL。
+    """
+    mode = "ab" if append else "wb"
+    if method == "gzip":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if method == "zstd":
+        raw = open(path, mode)
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=True)
+    return open(path, mode)
+
+
+# 讀取壓縮檔時尾端不完整（寫到一半中斷）會拋出的例外
+if zstandard is not None:
+    TruncatedError = (EOFError, gzip.BadGzipFile, zstandard.ZstdError)
+else:
+    TruncatedError = (EOFError, gzip.BadGzipFile)
@@ -0,0 +1,75 @@
+import hashlib
+import os
+from typing import Callable, Iterator, Optional
+
+# 用戶檔案依 user_id 的雜湊分散到兩層子目錄（例如 3f/a2/），每個目錄只放少量檔案
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+_HEX_DIGITS = set("0123456789abcdef")
+
+
+def user_shard(user_id: int) -> str:
+    """user_id -> 相對的分片目錄（例如 '3f/a2'）"""
+    digest = hashlib.sha1(str(user_id).encode("ascii")).hexdigest()
+    return os.path.join(*(digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+                          for level in range(SHARD_LEVELS)))
+
+
+def user_path(root: str, user_id: int, name: str) -> str:
+    return os.path.join(root, user_shard(user_id), name)
+
+
+def _is_shard_name(name: str) -> bool:
+    return len(name) == SHARD_WIDTH and set(name) <= _HEX_DIGITS
+
+
+def iter_user_entries(root: str) -> Iterator[os.DirEntry]:
+    """走訪所有分片目錄，逐一產生其中的項目；根目錄下的其他檔案與目錄（索引、預寫日誌等）不計"""
+
+    def walk(path: str, level: int) -> Iterator[os.DirEntry]:
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if level == SHARD_LEVELS:
+                        yield entry
+                    elif _is_shard_name(entry.name) and entry.is_dir():
+                        yield from walk(entry.path, level + 1)
+        except FileNotFoundError:
+            return
+
+    return walk(root, 0)
+
+
+def migrate_flat_layout(root: str, user_of: Callable[[str], Optional[int]]) -> int:
+    """把舊版直接放在 root 下的用戶檔案搬進分片目錄，回傳搬移的數量
+
+    user_of(名稱) 回傳該項目所屬的用戶，不是用戶檔案時回傳 None。
+    以 os.replace 逐一搬移，中途中斷後再執行一次即可接著完成；
+    搬移後根目錄只剩分片目錄，之後每次啟動的檢查只需掃描很小的目錄。
+    """
+    moved = 0
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+
+    for name in names:
+        if name.endswith(".tmp") or _is_shard_name(name):
+            continue
+        user_id = user_of(name)
+        if user_id is None:
+            continue
+        target = user_path(root, user_id, name)
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(root, name), target)
+            moved += 1
+        except FileNotFoundError:
+            continue  # 已被別的實例搬走
+        except OSError as e:
+            print(f"搬移 {name} 到分片目錄失敗: {e}")
+
+    if moved:
+        print(f"已將 {root} 中的 {moved} 個項目搬到分片目錄")
+    return moved
@@ -0,0 +1,262 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 日誌行數超過「項目數 × 此倍數」（且超過下限）時整檔重寫
+MANIFEST_COMPACT_RATIO = 2
+MANIFEST_COMPACT_MIN_LINES = 1000
+
+ChatEntry = Dict[str, object]   # {"time": 備份時間, "file": 目前檔名, "legacy": [舊版檔名]}
+
+
+class BackupManifest:
+    """JSON 備份的索引
+
+    記錄每位用戶目前的聊天備份檔、舊版檔案、最後備份時間以及是否有記憶備份，
+    讓查詢最新備份、統計數量都不必掃描目錄。索引本身是只追加的 JSONL，
+    每次寫入備份後追加一行；檔案遺失或損壞時用 scan 從磁碟重建。
+    同一份索引可被多個實例共用，查詢前 refresh() 會讀入別人追加的紀錄。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, scan: Callable[[], Tuple[Dict[int, ChatEntry], Dict[int, float]]]):
+        self.path = path
+        self._scan = scan
+        self._lock = threading.RLock()
+
+        self.chats: Dict[int, ChatEntry] = {}
+        self.memories: Dict[int, float] = {}
+        self.memory_digests: Dict[int, str] = {}   # 記憶內容摘要（掃描重建時未知）
+        self._shared_users = 0      # 同時有聊天與記憶備份的用戶數
+        self._latest_time = None
+        self._lines = 0
+        self._offset = 0            # 已讀入的位元組數，refresh 從這裡接著讀
+        self._inode = None
+        self._torn = False          # 讀到寫到一半或無法解析的紀錄
+
+        # 開啟時重建過（不存在、版本不符或損壞），或尾端有寫到一半的紀錄（更新索引時當機），
+        # 才需要和磁碟比對一次；正常讀入的索引直接採信，不必走訪所有分片目錄
+        loaded = self._load()
+        if not loaded:
+            self.rebuild()
+        self.needs_reconcile = not loaded or self._torn
+
+    # ----- 查詢 -----
+
+    @property
+    def total_users(self) -> int:
+        return len(self.chats) + len(self.memories) - self._shared_users
+
+    @property
+    def latest_time(self) -> Optional[float]:
+        return self._latest_time
+
+    def chat_time(self, user_id: int) -> Optional[float]:
+        entry = self.chats.get(user_id)
+        return entry["time"] if entry else None
+
+    # ----- 更新 -----
+
+    def set_chat(self, user_id: int, backup_time: float, filename: str,
+                 legacy: Optional[List[str]] = None) -> None:
+        entry = {"time": backup_time, "file": filename, "legacy": list(legacy or ())}
+        with self._lock:
+            self.refresh()  # 先讀入別人的紀錄，壓實時才不會蓋掉
+            self._apply_chat(user_id, entry)
+            self._append({"chat": user_id, **entry})
+
+    def remove_chat(self, user_id: int) -> None:
+        with self._lock:
+            self.refresh()
+            if self._apply_chat(user_id, None):
+                self._append({"chat": user_id, "deleted": True})
+
+    def set_memory(self, user_id: int, backup_time: float, digest: Optional[str] = None) -> None:
+        with self._lock:
+            self.refresh()
+            self._apply_memory(user_id, backup_time, digest)
+            record = {"memory": user_id, "time": backup_time}
+            if digest:
+                record["digest"] = digest
+            self._append(record)
+
+    def remove_memory(self, user_id: int) -> None:
+        with self._lock:
+            self.refresh()
+            if self._apply_memory(user_id, None):
+                self._append({"memory": user_id, "deleted": True})
+
+    def _apply_chat(self, user_id: int, entry: Optional[ChatEntry]) -> bool:
+        existed = user_id in self.chats
+        if entry is None:
+            if existed:
+                del self.chats[user_id]
+                if user_id in self.memories:
+                    self._shared_users -= 1
+            return existed
+
+        self.chats[user_id] = entry
+        if not existed and user_id in self.memories:
+            self._shared_users += 1
+        self._touch(entry["time"])
+        return True
+
+    def _apply_memory(self, user_id: int, backup_time: Optional[float], digest: Optional[str] = None) -> bool:
+        existed = user_id in self.memories
+        self.memory_digests.pop(user_id, None)
+        if backup_time is None:
+            if existed:
+                del self.memories[user_id]
+                if user_id in self.chats:
+                    self._shared_users -= 1
+            return existed
+
+        self.memories[user_id] = backup_time
+        if digest:
+            self.memory_digests[user_id] = digest
+        if not existed and user_id in self.chats:
+            self._shared_users += 1
+        self._touch(backup_time)
+        return True
+
+    def _touch(self, backup_time: float) -> None:
+        if self._latest_time is None or backup_time > self._latest_time:
+            self._latest_time = backup_time
+
+    # ----- 持久化 -----
+
+    def _append(self, record: dict) -> None:
+        try:
+            with open(self.path, "ab") as f:
+                position = f.tell()
+                f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                # 前面沒有別人追加的紀錄時直接前移；否則留給 refresh 一起讀
+                if position == self._offset:
+                    self._offset = f.tell()
+                    self._lines += 1
+        except OSError as e:
+            print(f"更新備份索引失敗: {e}")
+            return
+
+        entries = len(self.chats) + len(self.memories)
+        if self._lines > max(MANIFEST_COMPACT_MIN_LINES, entries * MANIFEST_COMPACT_RATIO):
+            self._write()
+
+    def _write(self) -> None:
+        """以目前狀態整檔重寫（先寫暫存檔再取代）"""
+        lines = [json.dumps({"manifest": self.VERSION})]
+        lines.extend(json.dumps({"chat": user_id, **entry}, ensure_ascii=False)
+                     for user_id, entry in self.chats.items())
+        for user_id, backup_time in self.memories.items():
+            record = {"memory": user_id, "time": backup_time}
+            if user_id in self.memory_digests:
+                record["digest"] = self.memory_digests[user_id]
+            lines.append(json.dumps(record))
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+        st = os.stat(self.path)
+        self._lines = len(lines)
+        self._inode = st.st_ino
+        self._offset = st.st_size
+
+    def _load(self) -> bool:
+        """讀取索引；檔案不存在或格式不符時回傳 False"""
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline() or b"{}")
+                if header.get("manifest") != self.VERSION:
+                    return False
+                self._lines = 1
+                self._inode = os.fstat(f.fileno()).st_ino
+                self._read_records(f)
+            return True
+
+        except (OSError, ValueError, KeyError) as e:
+            print(f"備份索引損壞，將重新建立: {e}")
+            self._reset()
+            return False
+
+    def _read_records(self, f) -> None:
+        """從目前位置讀到檔尾並套用；只處理完整的行，記下讀到的位置"""
+        self._offset = f.tell()
+        for line in f:
+            if not line.endswith(b"\n"):
+                self._torn = True
+                break  # 另一端還在寫的最後一行，下次再讀
+            self._offset += len(line)
+            self._lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                self._torn = True
+                continue  # 寫到一半中斷的行
+
+            if "chat" in record:
+                user_id = int(record["chat"])
+                self._apply_chat(user_id, None if record.get("deleted") else {
+                    "time": record["time"],
+                    "file": record["file"],
+                    "legacy": record.get("legacy", [])
+                })
+            elif "memory" in record:
+                self._apply_memory(int(record["memory"]),
+                                   None if record.get("deleted") else record["time"],
+                                   record.get("digest"))
+
+    def refresh(self) -> None:
+        """讀入其他 BackupManager 實例（或其他程序）追加的紀錄，只需一次 stat"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+
+        if st.st_ino == self._inode and st.st_size == self._offset:
+            return
+
+        with self._lock:
+            try:
+                if st.st_ino != self._inode or st.st_size < self._offset:
+                    # 被別的實例壓實重寫過，整份重讀
+                    self._reset()
+                    if not self._load():
+                        self.rebuild()
+                    return
+                with open(self.path, "rb") as f:
+                    f.seek(self._offset)
+                    self._read_records(f)
+            except OSError as e:
+                print(f"讀取備份索引失敗: {e}")
+
+    def _reset(self) -> None:
+        self.chats.clear()
+        self.memories.clear()
+        self.memory_digests.clear()
+        self._shared_users = 0
+        self._latest_time = None
+        self._lines = 0
+        self._offset = 0
+        self._inode = None
+
+    def rebuild(self) -> None:
+        """掃描磁碟重建索引"""
+        chats, memories = self._scan()
+        with self._lock:
+            self._reset()
+            for user_id, entry in chats.items():
+                self._apply_chat(user_id, entry)
+            for user_id, backup_time in memories.items():
+                self._apply_memory(user_id, backup_time)
+            try:
+                self._write()
+            except OSError as e:
+                print(f"寫入備份索引失敗: {e}")
+        print(f"已重建備份索引：聊天 {len(self.chats)} 位、記憶 {len(self.memories)} 位用戶")
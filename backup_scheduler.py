@@ -0,0 +1,102 @@
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+# 背景備份的寫入預算：每秒最多寫入的檔案數 / 位元組數（0 表示不限制）
+BACKUP_FILES_PER_SEC = float(os.getenv("BACKUP_FILES_PER_SEC", "20"))
+BACKUP_BYTES_PER_SEC = float(os.getenv("BACKUP_BYTES_PER_SEC", str(2 * 1024 * 1024)))
+# 每輪備份的寫入分散在間隔的這個比例內完成
+BACKUP_SPREAD_RATIO = float(os.getenv("BACKUP_SPREAD_RATIO", "0.5"))
+
+# 自適應間隔：依觀察到的訊息量調整，大約每累積這麼多則訊息備份一次，限制在上下限之間
+BACKUP_ADAPTIVE_INTERVAL = os.getenv("BACKUP_ADAPTIVE_INTERVAL", "1") == "1"
+BACKUP_TARGET_MESSAGES = int(os.getenv("BACKUP_TARGET_MESSAGES", "2000"))
+BACKUP_MIN_INTERVAL_MINUTES = float(os.getenv("BACKUP_MIN_INTERVAL_MINUTES", "5"))
+BACKUP_MAX_INTERVAL_MINUTES = float(os.getenv("BACKUP_MAX_INTERVAL_MINUTES", "60"))
+# 間隔隨機浮動的比例，多個部署不會在同一時刻一起寫入
+BACKUP_INTERVAL_JITTER = float(os.getenv("BACKUP_INTERVAL_JITTER", "0.1"))
+
+
+class WriteThrottle:
+    """控制一輪背景備份的寫入速度（在工作執行緒使用）
+
+    每次寫入前 acquire() 等到下一個可寫入的時間點；寫完後 record() 依本次寫入的
+    檔案數與位元組數推算下一次的時間。間隔取「平均分散在 spread_seconds 內」
+    與「檔案數 / 位元組預算」兩者中較長的一個，磁碟負載因此平滑且有上限。
+    """
+
+    def __init__(self, items: int, spread_seconds: float,
+                 files_per_sec: float = BACKUP_FILES_PER_SEC,
+                 bytes_per_sec: float = BACKUP_BYTES_PER_SEC):
+        self._gap = spread_seconds / items if items and spread_seconds > 0 else 0.0
+        self._files_per_sec = files_per_sec
+        self._bytes_per_sec = bytes_per_sec
+        self._next_time = time.monotonic()
+        self._last_start = self._next_time
+        self._unthrottled = threading.Event()
+        self.cancelled = False
+
+    def acquire(self) -> bool:
+        """等到可以寫入下一位用戶；整輪被取消時回傳 False"""
+        delay = self._next_time - time.monotonic()
+        if delay > 0 and not self._unthrottled.is_set():
+            self._unthrottled.wait(delay)
+        self._last_start = time.monotonic()
+        return not self.cancelled
+
+    def record(self, files: int, bytes_written: int) -> None:
+        cost = self._gap
+        if self._files_per_sec > 0:
+            cost = max(cost, files / self._files_per_sec)
+        if self._bytes_per_sec > 0:
+            cost = max(cost, bytes_written / self._bytes_per_sec)
+        self._next_time = max(self._next_time, self._last_start) + cost
+
+    def release(self) -> None:
+        """不再限速，剩下的用戶立即寫完（例如有手動備份在等待）"""
+        self._unthrottled.set()
+
+    def cancel(self) -> None:
+        """放棄剩下的寫入（例如關機時改由最終備份一次寫完）"""
+        self.cancelled = True
+        self._unthrottled.set()
+
+
+class BackupInterval:
+    """依觀察到的訊息速率選擇備份間隔
+
+    訊息多時縮短間隔，讓每輪的寫入量與預寫日誌大小維持在一定範圍；
+    沒有訊息時拉長到上限。每次的等待時間再加上隨機浮動。
+    """
+
+    def __init__(self, base_minutes: float, adaptive: bool = BACKUP_ADAPTIVE_INTERVAL):
+        self.minutes = float(base_minutes)
+        self.adaptive = adaptive
+        self._rate: Optional[float] = None   # 每分鐘訊息數（指數移動平均）
+
+    def observe(self, messages: int, elapsed_seconds: float) -> None:
+        """記下上一輪期間的訊息數，調整下一輪的間隔"""
+        if not self.adaptive or elapsed_seconds <= 0:
+            return
+
+        rate = messages / (elapsed_seconds / 60)
+        self._rate = rate if self._rate is None else 0.5 * rate + 0.5 * self._rate
+
+        if self._rate <= 0:
+            minutes = BACKUP_MAX_INTERVAL_MINUTES
+        else:
+            minutes = BACKUP_TARGET_MESSAGES / self._rate
+        self.minutes = min(max(minutes, BACKUP_MIN_INTERVAL_MINUTES), BACKUP_MAX_INTERVAL_MINUTES)
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    def next_wait_seconds(self) -> float:
+        jitter = random.uniform(-BACKUP_INTERVAL_JITTER, BACKUP_INTERVAL_JITTER)
+        return self.minutes * 60 * (1 + jitter)
+
+    def spread_seconds(self) -> float:
+        return self.minutes * 60 * BACKUP_SPREAD_RATIO
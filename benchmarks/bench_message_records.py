@@ -0,0 +1,79 @@
+"""比較每位活躍用戶的訊息記憶體用量：舊版 dict 與 MessageRecord
+
+用法: python benchmarks/bench_message_records.py [用戶數]
+"""
+import datetime
+import os
+import sys
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from message_record import MessageRecord  # noqa: E402
+
+HISTORY_LENGTH = 500
+SHORT_TERM_SIZE = 25
+
+
+def _sample_text(i: int) -> str:
+    return f"訓練員第{i}次來找喬伊聊天，今天想聊寶可夢對戰和道館的事情"
+
+
+def build_dict_user(user_index: int):
+    """舊版：聊天歷史與短期記憶各存一份 dict"""
+    history = []
+    short_term = deque(maxlen=SHORT_TERM_SIZE)
+    for i in range(HISTORY_LENGTH):
+        content = _sample_text(user_index * HISTORY_LENGTH + i)
+        sender = "user" if i % 2 == 0 else "bot"
+        history.append({
+            "sender": sender,
+            "content": content,
+            "timestamp": datetime.datetime.now().isoformat("#", "seconds")
+        })
+        short_term.append({
+            "content": content,
+            "sender": sender,
+            "timestamp": datetime.datetime.now().isoformat(),
+            "importance": 0.1,
+            "categories": []
+        })
+    return history, short_term
+
+
+def build_record_user(user_index: int):
+    """新版：兩個結構共用同一個 MessageRecord"""
+    history = []
+    short_term = deque(maxlen=SHORT_TERM_SIZE)
+    for i in range(HISTORY_LENGTH):
+        record = MessageRecord(_sample_text(user_index * HISTORY_LENGTH + i),
+                               "user" if i % 2 == 0 else "bot",
+                               importance=0.1, categories=())
+        history.append(record)
+        short_term.append(record)
+    return history, short_term
+
+
+def measure(builder, user_count: int) -> float:
+    tracemalloc.start()
+    users = [builder(i) for i in range(user_count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return current / user_count
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    dict_bytes = measure(build_dict_user, user_count)
+    record_bytes = measure(build_record_user, user_count)
+
+    print(f"用戶數: {user_count}，每位用戶 {HISTORY_LENGTH} 則歷史 + {SHORT_TERM_SIZE} 則短期記憶")
+    print(f"dict 版本:         {dict_bytes / 1024:8.1f} KiB / 用戶")
+    print(f"MessageRecord 版本: {record_bytes / 1024:8.1f} KiB / 用戶")
+    print(f"節省:              {(1 - record_bytes / dict_bytes) * 100:8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""比較備份序列化的吞吐量（MB/s）：舊版先走訪再 json.dump(indent=2) 與 serialization 各後端
+
+用法: python benchmarks/bench_serialization.py [用戶數]
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import serialization  # noqa: E402
+from message_record import MessageRecord  # noqa: E402
+
+HISTORY_LENGTH = 500
+SHORT_TERM_SIZE = 25
+IMPORTANT_SIZE = 10
+
+
+def _sample_text(i: int) -> str:
+    return f"訓練員第{i}次來找喬伊聊天，今天想聊寶可夢對戰和道館的事情"
+
+
+def build_user(user_index: int):
+    history = [MessageRecord(_sample_text(user_index * HISTORY_LENGTH + i),
+                             "user" if i % 2 == 0 else "bot",
+                             importance=0.1 * (i % 10), categories=("pokemon",))
+               for i in range(HISTORY_LENGTH)]
+    memory = {
+        "user_id": user_index,
+        "last_updated": datetime.datetime.now().isoformat(),
+        "short_term": deque(history[-SHORT_TERM_SIZE:], maxlen=SHORT_TERM_SIZE),
+        "important": history[-IMPORTANT_SIZE:],
+        "profile": {"trainer_name": f"小智{user_index}", "hobbies": ["對戰", "收集"]},
+        "conversation_summaries": "最近聊了道館挑戰",
+        "version": "2.0"
+    }
+    return history, memory
+
+
+def legacy_make_serializable(obj):
+    """舊版 BackupManager._make_serializable：寫入前先把整份資料走過一遍"""
+    if isinstance(obj, MessageRecord):
+        return obj.to_dict()
+    elif isinstance(obj, dict):
+        return {key: legacy_make_serializable(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple, deque)):
+        return [legacy_make_serializable(item) for item in obj]
+    elif isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return obj
+
+
+def bench_legacy(users, directory):
+    """舊版：聊天與記憶都是縮排 JSON 檔"""
+    start = time.perf_counter()
+    total = 0
+    for index, (history, memory) in enumerate(users):
+        for name, data in ((f"chat_{index}.json", {"messages": history}), (f"memory_{index}.json", memory)):
+            path = os.path.join(directory, name)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(legacy_make_serializable(data), f, ensure_ascii=False, indent=2)
+            total += os.path.getsize(path)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(len(users)):
+        for name in (f"chat_{index}.json", f"memory_{index}.json"):
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                json.load(f)
+    load_seconds = time.perf_counter() - start
+    return total, save_seconds, load_seconds
+
+
+def bench_backend(users, directory, backend):
+    """新版：聊天為精簡 JSONL，記憶為精簡 JSON，透過 default hook 編碼"""
+    _, dumps, dumps_line, loads, _ = serialization._LOADERS[backend]()
+
+    start = time.perf_counter()
+    total = 0
+    for index, (history, memory) in enumerate(users):
+        chat_data = b"".join(dumps_line(message) for message in history)
+        memory_data = dumps(memory)
+        for name, data in ((f"chat_{index}.jsonl", chat_data), (f"memory_{index}.json", memory_data)):
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+            total += len(data)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(len(users)):
+        with open(os.path.join(directory, f"chat_{index}.jsonl"), "rb") as f:
+            [loads(line) for line in f]
+        with open(os.path.join(directory, f"memory_{index}.json"), "rb") as f:
+            loads(f.read())
+    load_seconds = time.perf_counter() - start
+    return total, save_seconds, load_seconds
+
+
+def report(label, total, save_seconds, load_seconds):
+    mb = total / 1024 / 1024
+    print(f"{label:<22} {mb:6.1f} MB   保存 {save_seconds:6.2f} s ({mb / save_seconds:6.1f} MB/s)"
+          f"   載入 {load_seconds:6.2f} s ({mb / load_seconds:6.1f} MB/s)")
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    users = [build_user(i) for i in range(user_count)]
+
+    print(f"用戶數: {user_count}，每位用戶 {HISTORY_LENGTH} 則聊天記錄 + 記憶檔")
+    with tempfile.TemporaryDirectory() as directory:
+        report("舊版 json indent=2", *bench_legacy(users, directory))
+
+    for backend in ("json", "msgspec", "orjson"):
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                report(f"{backend} 精簡", *bench_backend(users, directory, backend))
+        except ImportError:
+            print(f"{backend:<22} 未安裝，略過")
+
+    print(f"目前使用: {serialization.BACKEND}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
-import json
 import os
 import datetime
 import pytz
 import asyncio
-import pickle
-from pathlib import Path
+import copy
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, Callable
-from collections import deque
+
+from message_record import to_record
+from storage_backends import StorageBackend, create_backend
+from message_wal import MessageWAL
+from backup_scheduler import BackupInterval, WriteThrottle
+from snapshot_store import SnapshotStore
+import serialization
+
+# 每次完整備份後記錄時間點快照（完整快照 + 差異，依保留策略修剪）
+SNAPSHOTS_ENABLED = os.getenv("SNAPSHOTS_ENABLED", "1") == "1"
+
+# 每位用戶保留的聊天訊息上限（Talking 的記憶體歷史、載入備份與匯入工具共用）
+MAX_HISTORY_LENGTH = 500
+
+# 不限速備份寫入 SQLite 時，每批合併成一次交易的用戶數
+BACKUP_BATCH_SIZE = max(1, int(os.getenv("BACKUP_BATCH_SIZE", "50")))
 
 class BackupManager:
     """統一的備份管理系統"""
     
-    def __init__(self, backup_directory: str = "chat_backups", memory_directory: str = "joy_memory"):
+    def __init__(self, backup_directory: str = "chat_backups", memory_directory: str = "joy_memory",
+                 storage: Optional[StorageBackend] = None):
         self.backup_directory = backup_directory
         self.memory_directory = memory_directory
         self.taiwan_tz = pytz.timezone('Asia/Taipei')
@@ -20,9 +38,62 @@ class BackupManager:
         os.makedirs(self.backup_directory, exist_ok=True)
         os.makedirs(self.memory_directory, exist_ok=True)
         
+        # 存儲後端：未指定時依環境變數 BACKUP_BACKEND 選擇 json 或 sqlite
+        self.storage = storage or create_backend(self.backup_directory, self.memory_directory)
+        
+        self.closed = False
+        
         # 備份任務相關
         self._backup_task = None
         self._is_running = False
+        # 定時備份排定的下一次時間與目前間隔（分鐘），備份循環未啟動時為 None
+        self.next_backup_time: Optional[datetime.datetime] = None
+        self.backup_interval_minutes: Optional[float] = None
+        self._throttle: Optional[WriteThrottle] = None   # 進行中的限速備份
+        # 進行中的完整備份還沒寫入的用戶；期間由單一用戶備份寫入較新資料的用戶會被移除，
+        # 完整備份就不會再用較舊的快照覆蓋
+        self._cycle_chat_pending = set()
+        self._cycle_memory_pending = set()
+        self._user_backups = {}                          # user_id -> 進行中的單一用戶備份
+        self._messages_since_backup = 0                  # 估計訊息速率用
+        
+        # 變動追蹤：每次變動版本號 +1，寫入成功後記下已保存的版本
+        # 兩者相同（或都不存在）代表該用戶自上次保存後沒有變動
+        self._chat_versions = {}          # user_id -> 目前版本
+        self._chat_saved_versions = {}    # user_id -> 已保存版本
+        self._memory_versions = {}
+        self._memory_saved_versions = {}
+        
+        # user_id -> 最後寫入存儲的訊息，用來找出之後新增的訊息
+        self._chat_persisted = {}
+        
+        # 備份在工作執行緒寫入：版本號的讀寫與單一用戶的寫入各自加鎖，
+        # 事件循環最多只需等待一位用戶（SQLite 不限速備份時為一小批）寫完
+        self._version_lock = threading.Lock()
+        self._storage_lock = threading.RLock()
+        self._backup_lock = asyncio.Lock()  # 避免定時備份與手動備份同時進行
+        self._clear_counts = {}             # user_id -> 被清除的次數
+        # 載入時每位用戶最多保留的訊息數
+        self.max_history_length = MAX_HISTORY_LENGTH
+        
+        # 訊息預寫日誌，由 open_wal() 開啟（只有負責對話的 Talking 使用）
+        self.wal: Optional[MessageWAL] = None
+        
+        # 時間點快照，可還原用戶在過去某個時間的聊天與記憶
+        self.snapshots: Optional[SnapshotStore] = (
+            SnapshotStore(os.path.join(self.backup_directory, "snapshots")) if SNAPSHOTS_ENABLED else None
+        )
+        
+    def open_wal(self) -> Dict[int, list]:
+        """開啟預寫日誌，回傳上次備份後、當機前尚未寫入備份的訊息 {user_id: [MessageRecord]}"""
+        
+        if self.wal is None:
+            self.wal = MessageWAL(os.path.join(self.backup_directory, "wal"))
+        replayed = self.wal.replay()
+        if replayed:
+            count = sum(len(records) for records in replayed.values())
+            print(f"預寫日誌中有 {len(replayed)} 位用戶的 {count} 則訊息待重播")
+        return replayed
         
     async def start_backup_loop(self, message_history_ref: Dict, memory_manager_ref: Any, 
                                interval_minutes: int = 15) -> None:
@@ -32,36 +103,32 @@ class BackupManager:
             return
             
         self._is_running = True
-        print(f"備份循環已啟動，每 {interval_minutes} 分鐘執行一次")
+        schedule = BackupInterval(interval_minutes)
+        print(f"備份循環已啟動，基準間隔 {interval_minutes} 分鐘（依訊息量自動調整）")
         
+        cycle_started = time.monotonic()
         while self._is_running:
             try:
-                now = datetime.datetime.now(self.taiwan_tz)
-                next_minute = (now.minute // interval_minutes + 1) * interval_minutes
-                
-                if next_minute >= 60:
-                    next_minute = 0
-                    next_hour = (now.hour + 1) % 24
-                else:
-                    next_hour = now.hour
-
-                next_run_time = now.replace(
-                    hour=next_hour,
-                    minute=next_minute,
-                    second=0,
-                    microsecond=0
-                )
-            
-                if next_run_time <= now:
-                    next_run_time += datetime.timedelta(minutes=interval_minutes)
-
-                wait_seconds = (next_run_time - now).total_seconds()
+                # 不對齊整點／整刻，加上隨機浮動，多個部署不會同時寫入
+                wait_seconds = max(0.0, schedule.next_wait_seconds() - (time.monotonic() - cycle_started))
+                next_run_time = datetime.datetime.now(self.taiwan_tz) + datetime.timedelta(seconds=wait_seconds)
+                self.next_backup_time = next_run_time
+                self.backup_interval_minutes = schedule.minutes
                 print(f"下一次自動備份將在 {next_run_time.strftime('%Y-%m-%d %H:%M:%S')} 執行\n")
                 
                 await asyncio.sleep(wait_seconds)
+                self.next_backup_time = None  # 備份進行中
                 
                 if self._is_running:  # 檢查是否仍在運行
-                    await self.perform_backup(message_history_ref, memory_manager_ref)
+                    now = time.monotonic()
+                    schedule.observe(self._take_message_count(), now - cycle_started)
+                    cycle_started = now
+                    if schedule.rate is not None:
+                        print(f"近期訊息量約每分鐘 {schedule.rate:.1f} 則，備份間隔 {schedule.minutes:.1f} 分鐘")
+                    
+                    # 寫入分散在間隔的前段，避免集中在同一時刻
+                    await self.perform_backup(message_history_ref, memory_manager_ref,
+                                              spread_seconds=schedule.spread_seconds())
                 
             except asyncio.CancelledError:
                 print("定時備份任務已取消")
@@ -72,27 +139,160 @@ class BackupManager:
                 print("一分鐘後自動重試")
                 await asyncio.sleep(60) 
 
-    async def perform_backup(self, message_history: Dict, memory_manager: Any) -> None:
-        """執行完整備份"""
-        try:
-            print(f"正在執行完整備份... 時間(UTC+8): {datetime.datetime.now(self.taiwan_tz).strftime('%Y-%m-%d %H:%M:%S')}")
-            
-            # 備份聊天歷史
-            if message_history:
-                self.save_chat_history(message_history)
+    async def perform_backup(self, message_history: Dict, memory_manager: Any,
+                             spread_seconds: float = 0) -> None:
+        """執行完整備份
+
+        在事件循環上取得淺層快照（只複製有變動用戶的訊息列表），
+        序列化與檔案 I/O 交給工作執行緒，備份期間機器人仍可正常回覆。
+        spread_seconds > 0 時（定時備份）各用戶的寫入依預算分散在這段時間內。
+        """
+        if spread_seconds <= 0 and self._throttle:
+            # 手動備份不必等限速中的定時備份慢慢寫完
+            self._throttle.release()
+        
+        async with self._backup_lock:
+            try:
+                print(f"正在執行完整備份... 時間(UTC+8): {datetime.datetime.now(self.taiwan_tz).strftime('%Y-%m-%d %H:%M:%S')}")
                 
-            # 備份記憶系統
-            if memory_manager:
-                self.save_memory_system(memory_manager)
+                # 快照前換到新的日誌段，舊段的訊息都包含在這次快照中
+                wal_segment = self.wal.rotate() if self.wal else None
                 
-            print(f"完整備份完成 時間(UTC+8): {datetime.datetime.now(self.taiwan_tz).strftime('%Y-%m-%d %H:%M:%S')}\n")
+                chat_snapshot = self._snapshot_chat_history(message_history) if message_history else None
+                memory_snapshot = self._snapshot_memory_system(memory_manager) if memory_manager else None
+                
+                with self._storage_lock:
+                    self._cycle_chat_pending = {entry[0] for entry in chat_snapshot or ()}
+                    self._cycle_memory_pending = {entry[0] for entry in memory_snapshot or ()}
+                
+                if spread_seconds > 0:
+                    items = len(chat_snapshot or ()) + len(memory_snapshot or ())
+                    if self.snapshots:
+                        # 時間點快照每位用戶也要寫一次，同樣分散在間隔內
+                        items += len({entry[0] for entry in chat_snapshot or ()} |
+                                     {entry[0] for entry in memory_snapshot or ()})
+                    self._throttle = WriteThrottle(items, spread_seconds)
+                try:
+                    await asyncio.to_thread(self._write_snapshot, chat_snapshot, memory_snapshot,
+                                            wal_segment, self._throttle, True)
+                finally:
+                    self._throttle = None
+                    with self._storage_lock:
+                        self._cycle_chat_pending = set()
+                        self._cycle_memory_pending = set()
+                    
+                print(f"完整備份完成 時間(UTC+8): {datetime.datetime.now(self.taiwan_tz).strftime('%Y-%m-%d %H:%M:%S')}\n")
+                
+            except Exception as e:
+                print(f"執行備份時發生錯誤: {e}")
+
+    def _write_snapshot(self, chat_snapshot: Optional[list], memory_snapshot: Optional[list],
+                        wal_segment: Optional[int] = None, throttle: Optional[WriteThrottle] = None,
+                        cycle: bool = False) -> None:
+        """把快照寫入存儲（在工作執行緒執行）；全部寫入成功才清除舊的預寫日誌段
+
+        cycle 表示這是 perform_backup 的快照，期間已有較新資料寫入的用戶會略過。
+        """
+        
+        complete = True
+        
+        # 備份聊天歷史
+        if chat_snapshot is not None:
+            complete &= self._write_chat_snapshot(chat_snapshot, throttle, cycle)
             
-        except Exception as e:
-            print(f"執行備份時發生錯誤: {e}")
+        # 備份記憶系統
+        if memory_snapshot is not None:
+            complete &= self._write_memory_snapshot(memory_snapshot, throttle, cycle)
+        
+        if self.snapshots and not (throttle and throttle.cancelled):
+            self._record_snapshots(chat_snapshot or (), memory_snapshot or (), throttle)
+        
+        if wal_segment is not None and self.wal:
+            if complete:
+                self.wal.discard_before(wal_segment)
+            else:
+                print("部分用戶備份失敗，保留預寫日誌")
+
+    def _record_snapshots(self, chat_snapshot, memory_snapshot,
+                          throttle: Optional[WriteThrottle] = None) -> None:
+        """把這次備份的內容記成時間點快照；只寫入新增的訊息與有變動的記憶
+
+        限速備份時每位用戶的快照和聊天、記憶一樣先經過 throttle，不會在一輪結束時集中寫入。
+        """
+        
+        histories = {entry[0]: (entry[1], entry[3]) for entry in chat_snapshot}
+        memories = {entry[0]: (entry[1], entry[3]) for entry in memory_snapshot}
+        recorded = 0
+        
+        for user_id in histories.keys() | memories.keys():
+            history, chat_clears = histories.get(user_id, (None, None))
+            memory_data, memory_clears = memories.get(user_id, (None, None))
+            if throttle and not throttle.acquire():
+                break
+            written = self.snapshots.bytes_written
+            files = 0
+            with self._storage_lock:
+                # 快照之後用戶已被清除時略過
+                if self._clear_counts.get(user_id, 0) in (chat_clears, memory_clears):
+                    try:
+                        entry = self.snapshots.record(user_id, history, memory_data)
+                        if entry:
+                            recorded += 1
+                            files = 1 + ("file" in entry) + ("memory" in entry)   # 索引與資料檔
+                    except Exception as e:
+                        print(f"記錄用戶 {user_id} 的時間點快照失敗: {e}")
+            if throttle:
+                throttle.record(files, self.snapshots.bytes_written - written)
+        
+        if recorded:
+            print(f"已記錄 {recorded} 位用戶的時間點快照")
+
+    def list_user_snapshots(self, user_id: int) -> list:
+        """列出用戶可還原的時間點（台灣時間，由舊到新）"""
+        
+        if not self.snapshots:
+            return []
+        return [datetime.datetime.fromtimestamp(entry["time"], self.taiwan_tz)
+                for entry in self.snapshots.list_snapshots(user_id)]
+
+    def restore_user_snapshot(self, user_id: int, at: Optional[datetime.datetime] = None) -> Optional[Dict]:
+        """把用戶的聊天與記憶還原成 at 當下最近一個快照的內容並寫回存儲
+
+        寫回前先標記為已清除，進行中的備份不會再用舊快照覆蓋；
+        機器人執行中時 Talking 記憶體裡的資料不會改變，請在停機時使用。
+        回傳還原的快照（{"time", "messages", "memory"}），沒有可用快照時回傳 None。
+        """
+        if not self.snapshots:
+            print("時間點快照未啟用")
+            return None
+        
+        restored = self.snapshots.restore(user_id, at.timestamp() if at else None, self.max_history_length)
+        if restored is None:
+            return None
+        
+        with self._storage_lock:
+            self._mark_cleared(user_id)
+            self._chat_persisted.pop(user_id, None)
+            with self.storage.batch():
+                if restored["messages"]:
+                    self.storage.replace_chat(user_id, restored["messages"])
+                else:
+                    self.storage.delete_chat(user_id)
+                if restored["memory"] is not None:
+                    memory_data = restored["memory"]
+                    self.storage.save_memory(user_id, memory_data,
+                                             serialization.digest(memory_data, serialization.MEMORY_VOLATILE_FIELDS))
+        
+        restored_at = datetime.datetime.fromtimestamp(restored["time"], self.taiwan_tz)
+        print(f"已將用戶 {user_id} 還原到 {restored_at.strftime('%Y-%m-%d %H:%M:%S')} 的快照"
+              f"（{len(restored['messages'])} 則聊天記錄）")
+        return restored
 
     def stop_backup_loop(self) -> None:
         """停止備份循環"""
         self._is_running = False
+        self.next_backup_time = None
+        self.backup_interval_minutes = None
         print("備份循環已停止")
 
     def final_backup(self, message_history: Dict, memory_manager: Any) -> None:
@@ -100,353 +300,575 @@ class BackupManager:
         try:
             print("\n 執行最終備份...")
             
-            if message_history:
-                self.save_chat_history(message_history)
-                
-            if memory_manager:
-                self.save_memory_system(memory_manager)
+            # 限速中的定時備份停止寫入，剩下的由這裡一次寫完
+            if self._throttle:
+                self._throttle.cancel()
+            
+            wal_segment = self.wal.rotate() if self.wal else None
+            chat_snapshot = self._snapshot_chat_history(message_history) if message_history else None
+            memory_snapshot = self._snapshot_memory_system(memory_manager) if memory_manager else None
+            self._write_snapshot(chat_snapshot, memory_snapshot, wal_segment)
                 
             print("最終備份完成\n")
             
         except Exception as e:
             print(f"最終備份失敗: {e}")
 
-    # ==================== 聊天記錄備份 ====================
+    # ==================== 變動追蹤 ====================
     
-    def delete_old_chat_backups(self, user_id: int) -> None:
-        """刪除指定用戶的舊聊天備份"""
-        abs_path = os.path.abspath(self.backup_directory)
-        
-        if not os.path.exists(abs_path):
-            return
-
-        old_backups = []
-        for filename in os.listdir(abs_path):
-            if filename.startswith(f"chat_backup_{user_id}_") and filename.endswith(".json"):
-                filepath = os.path.join(abs_path, filename)
-                old_backups.append(filepath)
+    def mark_chat_dirty(self, user_id: int) -> None:
+        """標記用戶聊天歷史有變動（update_message_history 呼叫，每則訊息一次）"""
+        with self._version_lock:
+            self._chat_versions[user_id] = self._chat_versions.get(user_id, 0) + 1
+            self._messages_since_backup += 1
+    
+    def _take_message_count(self) -> int:
+        """取出上次呼叫後的訊息數並歸零"""
+        with self._version_lock:
+            count, self._messages_since_backup = self._messages_since_backup, 0
+            return count
+    
+    def mark_memory_dirty(self, user_id: int) -> None:
+        """標記用戶記憶有變動（add_message 呼叫）"""
+        with self._version_lock:
+            self._memory_versions[user_id] = self._memory_versions.get(user_id, 0) + 1
+    
+    def is_chat_dirty(self, user_id: int) -> bool:
+        return self._chat_versions.get(user_id, 0) != self._chat_saved_versions.get(user_id, 0)
+    
+    def is_memory_dirty(self, user_id: int) -> bool:
+        return self._memory_versions.get(user_id, 0) != self._memory_saved_versions.get(user_id, 0)
+    
+    def _record_saved(self, versions: Dict, saved_versions: Dict, user_id: int, version: int) -> None:
+        """記下寫入成功的版本；期間沒有新變動就把兩邊都清掉，乾淨的用戶不佔空間"""
+        with self._version_lock:
+            if versions.get(user_id, 0) == version:
+                versions.pop(user_id, None)
+                saved_versions.pop(user_id, None)
+            else:
+                saved_versions[user_id] = version
 
-        if not old_backups:
-            return
+    # ==================== 聊天記錄備份 ====================
+    #
+    # 每次備份只把上次寫入後新增的訊息交給後端追加；對不上（首次保存、
+    # 被清除或舊資料）或後端存了太多已裁剪的舊訊息時才整份重寫。
 
-        for old_file_path in old_backups:
+    def delete_old_chat_backups(self, user_id: int) -> None:
+        """刪除指定用戶的所有聊天備份"""
+        
+        with self._storage_lock:
+            self._mark_cleared(user_id)
+            self._chat_persisted.pop(user_id, None)
             try:
-                os.remove(old_file_path)
-                print(f"  - 已刪除舊聊天備份: {os.path.basename(old_file_path)}")
-                
-            except OSError as e:
-                print(f"  - 無法刪除備份檔案 {os.path.basename(old_file_path)}: {e}")
+                self.storage.delete_chat(user_id)
+            except Exception as e:
+                print(f"  - 無法刪除用戶 {user_id} 的聊天備份: {e}")
+            
+            # 用戶要求清除時，過去的時間點快照一併刪除
+            if self.snapshots:
+                self.snapshots.delete_user(user_id)
+
+    def _write_chunks(self, snapshot: list, throttle: Optional[WriteThrottle]) -> list:
+        """把快照切成要一起寫入的幾批，每批在 _chunk_batch 之內寫入
+
+        只有不限速、且後端支援交易（SQLite）時才以 BACKUP_BATCH_SIZE 位用戶為一批，
+        其餘情況每位用戶各自寫入、各自持鎖。
+        """
+        size = BACKUP_BATCH_SIZE if throttle is None and self.storage.transactional else 1
+        return [snapshot[start:start + size] for start in range(0, len(snapshot), size)]
+
+    @contextmanager
+    def _chunk_batch(self, throttle: Optional[WriteThrottle]):
+        """把一批寫入合併成一次交易
+
+        交易期間持有 _storage_lock：事件循環上的清除等操作先在鎖上等待（最多一小批），
+        不會在拿到鎖之後才去等工作執行緒持有的 SQLite 寫入鎖而互相卡住。
+        """
+        if throttle is not None or not self.storage.transactional:
+            yield
+            return
+        with self._storage_lock, self.storage.batch():
+            yield
+
+    def _mark_cleared(self, user_id: int) -> None:
+        """用戶資料被清除；清除前取得的快照不可再寫回，預寫日誌中的舊訊息也不再重播"""
+        self._clear_counts[user_id] = self._clear_counts.get(user_id, 0) + 1
+        if self.wal:
+            self.wal.append_clear(user_id)
+
+    def _snapshot_chat_history(self, message_history_data: Dict, only_dirty: bool = True) -> list:
+        """在事件循環上複製要備份的聊天歷史：[(user_id, 訊息列表, 版本, 清除次數)]
+
+        只複製列表本身，MessageRecord 由雙方共用；複製一個列表很快，
+        不會和 on_message 的修改互相干擾。
+        """
+        snapshot = []
+        for user_id, history in list(message_history_data.items()):
+            if not history:
+                continue
+            if only_dirty and not self.is_chat_dirty(user_id):
+                continue
+            snapshot.append((user_id, list(history), self._chat_versions.get(user_id, 0),
+                             self._clear_counts.get(user_id, 0)))
+        return snapshot
+
+    def _write_chat_snapshot(self, snapshot: list, throttle: Optional[WriteThrottle] = None,
+                             cycle: bool = False) -> bool:
+        """寫入聊天快照；回傳是否每位用戶都寫入成功"""
+        saved_count = 0
+        for chunk in self._write_chunks(snapshot, throttle):
+            with self._chunk_batch(throttle):
+                for user_id, history, version, clear_count in chunk:
+                    if throttle and not throttle.acquire():
+                        break
+                    written = self.storage.bytes_written
+                    if self._save_chat_snapshot(user_id, history, version, clear_count, throttle, cycle):
+                        saved_count += 1
+                    if throttle:
+                        throttle.record(1, self.storage.bytes_written - written)
+            if throttle and throttle.cancelled:
+                break
+        
+        print(f"聊天紀錄備份完成 - 已備份 {saved_count} 位用戶\n")
+        return saved_count == len(snapshot)
 
-    def save_chat_history(self, message_history_data: Dict) -> None:
-        """保存聊天歷史"""
+    def save_chat_history(self, message_history_data: Dict, only_dirty: bool = True) -> None:
+        """保存聊天歷史；預設只寫入上次保存後有變動的用戶"""
         if not message_history_data:
             print("無聊天紀錄可備份")
             return
 
-        abs_path = os.path.abspath(self.backup_directory)
-        os.makedirs(abs_path, exist_ok=True)
+        self._write_chat_snapshot(self._snapshot_chat_history(message_history_data, only_dirty))
 
-        for user_id, history in message_history_data.items():
-            if not history:
-                continue
+    def save_user_chat_history(self, user_id: int, history: list) -> bool:
+        """保存單一用戶的聊天歷史：追加新訊息，必要時整份重寫"""
+        
+        return self._save_chat_snapshot(user_id, list(history), self._chat_versions.get(user_id, 0),
+                                        self._clear_counts.get(user_id, 0))
 
+    async def flush_user_histories(self, histories: Dict[int, list]) -> list:
+        """移出記憶體前保存多位用戶的聊天歷史，回傳已經沒有未保存變動、可以移出的用戶"""
+        
+        entries = [(user_id, list(history), self._chat_versions.get(user_id, 0),
+                    self._clear_counts.get(user_id, 0))
+                   for user_id, history in histories.items()
+                   if history and self.is_chat_dirty(user_id)]
+        
+        if entries:
+            await asyncio.to_thread(self._save_entries, self._save_chat_snapshot, entries)
+        return [user_id for user_id, history in histories.items()
+                if not history or not self.is_chat_dirty(user_id)]
+
+    async def backup_user(self, user_id: int, history: Optional[list], memory_manager: Any = None) -> bool:
+        """只備份單一用戶的聊天歷史與記憶（手動備份用），回傳是否成功
+
+        同一用戶已有備份在進行時直接等待那一次，連續點擊不會排入重複的寫入；
+        沒有變動的部分不寫入。
+        """
+        task = self._user_backups.get(user_id)
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._backup_user(user_id, history, memory_manager))
+            self._user_backups[user_id] = task
+            task.add_done_callback(
+                lambda done: self._user_backups.pop(user_id, None) if self._user_backups.get(user_id) is done else None
+            )
+        
+        return await asyncio.shield(task)
+
+    async def _backup_user(self, user_id: int, history: Optional[list], memory_manager: Any) -> bool:
+        # 快照在事件循環上取得，寫入交給工作執行緒
+        chat_entry = None
+        if history and self.is_chat_dirty(user_id):
+            chat_entry = (user_id, list(history), self._chat_versions.get(user_id, 0),
+                          self._clear_counts.get(user_id, 0))
+        
+        memory_entry = None
+        if memory_manager is not None and self.is_memory_dirty(user_id):
+            memory_entry = self._snapshot_user_memory(memory_manager, user_id)
+        
+        if chat_entry is None and memory_entry is None:
+            print(f"用戶 {user_id} 自上次備份後沒有變動，略過寫入")
+            return True
+        
+        return await asyncio.to_thread(self._write_user_snapshot, chat_entry, memory_entry)
+
+    def _write_user_snapshot(self, chat_entry: Optional[tuple], memory_entry: Optional[tuple]) -> bool:
+        saved = True
+        if chat_entry is not None:
+            saved &= self._save_chat_snapshot(*chat_entry)
+        if memory_entry is not None:
+            saved &= self._save_memory_snapshot(*memory_entry)
+        return saved
+
+    def _save_chat_snapshot(self, user_id: int, history: list, version: int, clear_count: int,
+                            throttle: Optional[WriteThrottle] = None, cycle: bool = False) -> bool:
+        with self._storage_lock:
+            if self._clear_counts.get(user_id, 0) != clear_count:
+                return False  # 快照之後用戶已被清除
+            if throttle and throttle.cancelled:
+                return False  # 最終備份已接手，不可用舊快照覆蓋
+            if cycle and user_id not in self._cycle_chat_pending:
+                return True   # 期間已寫入較新的資料
+            
             try:
-                self.delete_old_chat_backups(user_id)
-
-                timestamp = datetime.datetime.now(self.taiwan_tz).strftime("%Y%m%d_%H%M%S_%f")
-                backup_file = os.path.join(abs_path, f"chat_backup_{user_id}_{timestamp}.json")
-                
-                # 確保歷史記錄是可序列化的
-                serializable_history = self._make_serializable(history)
+                new_messages = self._unsaved_messages(user_id, history)
                 
-                with open(backup_file, 'w', encoding='utf-8') as f:
-                    json.dump({
-                        "user_id": user_id,
-                        "backup_time": datetime.datetime.now(self.taiwan_tz).isoformat(),
-                        "message_count": len(serializable_history),
-                        "messages": serializable_history
-                    }, f, ensure_ascii=False, indent=2)
+                if new_messages is None or (
+                        new_messages and not self.storage.append_chat(user_id, new_messages)):
+                    self.storage.replace_chat(user_id, history)
+                    print(f"已備份用戶 {user_id} 的 {len(history)} 則聊天記錄（重寫）")
+                elif new_messages:
+                    print(f"已備份用戶 {user_id} 的 {len(new_messages)} 則新聊天記錄")
+                    
+                    # 存儲中累積太多已裁剪的舊訊息時壓實
+                    if self.storage.needs_compaction(user_id, len(history)):
+                        self.storage.replace_chat(user_id, history)
+                        print(f"已壓實用戶 {user_id} 的聊天記錄")
 
-                print(f"已備份用戶 {user_id} 的 {len(history)} 則聊天記錄")
+                self._chat_persisted[user_id] = history[-1]
+                self._record_saved(self._chat_versions, self._chat_saved_versions, user_id, version)
+                self._cycle_chat_pending.discard(user_id)
+                return True
 
             except Exception as e:
                 print(f"儲存用戶 {user_id} 聊天紀錄時發生錯誤: {e}")
-                continue
+                return False
+
+    def _unsaved_messages(self, user_id: int, history: list) -> Optional[list]:
+        """找出上次寫入後新增的訊息；無法對上時回傳 None 表示需要整份重寫"""
         
-        print("聊天紀錄備份完成\n")
+        last = self._chat_persisted.get(user_id)
+        if last is None:
+            return None
+        
+        # 從尾端往回找上次寫入的最後一則，成本與新訊息數成正比
+        for index in range(len(history) - 1, -1, -1):
+            if history[index] is last:
+                return history[index + 1:]
+        return None
 
-    def load_chat_history(self) -> Dict:
-        """載入聊天歷史"""
+    def load_chat_history(self, max_workers: int = 1) -> Dict:
+        """載入聊天歷史；max_workers > 1 時以執行緒池並行讀取各用戶"""
         
-        loaded_history = {}
-        abs_path = os.path.abspath(self.backup_directory)
+        print(f"正在從 {self.storage.name} 備份載入聊天紀錄...")
         
-        if not os.path.exists(abs_path):
-            print(f"備份目錄 {abs_path} 不存在")
+        if max_workers <= 1:
+            loaded_history = {}
+            for user_id, messages in self.storage.load_chats(self.max_history_length).items():
+                loaded_history[user_id] = self._remember_loaded_chat(user_id, messages)
+                print(f" 已載入用戶 {user_id} 的 {len(messages)} 則聊天記錄")
             return loaded_history
         
-        print(f"正在從 {abs_path} 載入聊天紀錄...")
-
-        latest_user_backups = {}  # {user_id: (timestamp_obj, file_path)}
-
-        for filename in os.listdir(abs_path):
-            if filename.startswith('chat_backup_') and filename.endswith('.json'):
-                filepath = os.path.join(abs_path, filename)
-                try:
-                    parts = filename.split('_')
-                    if len(parts) >= 6:
-                        user_id = int(parts[2])
-                        timestamp_str = f"{parts[3]}_{parts[4]}_{parts[5].split('.')[0]}"
-                        timestamp = datetime.datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S_%f")
+        user_ids = self.get_chat_users()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="history-load") as executor:
+            results = executor.map(self.load_user_chat_history, user_ids)
+            loaded_history = {
+                user_id: records
+                for user_id, records in zip(user_ids, results)
+                if records is not None
+            }
+        
+        print(f" 已並行載入 {len(loaded_history)} 位用戶的聊天記錄（{max_workers} 個執行緒）")
+        return loaded_history
 
-                        if user_id not in latest_user_backups or timestamp > latest_user_backups[user_id][0]:
-                            latest_user_backups[user_id] = (timestamp, filepath)
+    def get_chat_users(self) -> list:
+        """列出有聊天備份的用戶，只讀索引（延遲載入模式啟動時使用）"""
+        
+        try:
+            return self.storage.chat_users()
+        except Exception as e:
+            print(f"讀取聊天備份用戶失敗: {e}")
+            return []
 
-                except Exception as e:
-                    print(f"解析檔案 {filename} 時發生錯誤: {e}")
-                    continue
+    def load_user_chat_history(self, user_id: int) -> Optional[list]:
+        """載入單一用戶的聊天歷史（閒置用戶被移出記憶體後重新載入用）"""
+        
+        try:
+            messages = self.storage.load_chat(user_id, self.max_history_length)
+        except Exception as e:
+            print(f" 載入用戶 {user_id} 聊天紀錄時發生錯誤: {e}")
+            return None
+        
+        if messages is None:
+            return None
+        
+        records = self._remember_loaded_chat(user_id, messages)
+        if records:
+            print(f" 已重新載入用戶 {user_id} 的 {len(records)} 則聊天記錄")
+        return records
 
-        for user_id, (timestamp, filepath) in latest_user_backups.items():
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    backup_data = json.load(f)
-                    
-                    # 兼容舊格式和新格式
-                    if isinstance(backup_data, list):
-                        # 舊格式：直接是訊息列表
-                        loaded_history[user_id] = backup_data
-                        message_count = len(backup_data)
-                    else:
-                        # 新格式：包含metadata的物件
-                        loaded_history[user_id] = backup_data.get("messages", [])
-                        message_count = backup_data.get("message_count", len(loaded_history[user_id]))
-                    
-                    print(f" 已載入用戶 {user_id} 的 {message_count} 則聊天記錄")
-            
-            except Exception as e:
-                print(f" 載入備份檔 {filepath} 時發生錯誤: {e}")
-                continue
+    def _remember_loaded_chat(self, user_id: int, messages: list) -> list:
+        """轉成 MessageRecord 並記下最後一則，之後的備份可直接追加"""
+        
+        records = [to_record(message) for message in messages]
+        if records:
+            self._chat_persisted[user_id] = records[-1]
+        else:
+            self._chat_persisted.pop(user_id, None)
+        return records
 
-        return loaded_history
+    def get_recent_chat_users(self, limit: int) -> list:
+        """依最後聊天備份時間由新到舊列出用戶（啟動時預先載入用）"""
+        
+        try:
+            return self.storage.recent_chat_users(limit)
+        except Exception as e:
+            print(f"讀取最近聊天用戶失敗: {e}")
+            return []
 
     # ==================== 記憶系統備份 ====================
     
-    def save_memory_system(self, memory_manager: Any) -> None:
-        """保存記憶系統數據"""
+    def save_memory_system(self, memory_manager: Any, only_dirty: bool = True) -> None:
+        """保存記憶系統數據；預設只寫入上次保存後有變動的用戶"""
+        
+        snapshot = self._snapshot_memory_system(memory_manager, only_dirty)
+        if snapshot is not None:
+            self._write_memory_snapshot(snapshot)
+
+    def _snapshot_memory_system(self, memory_manager: Any, only_dirty: bool = True) -> Optional[list]:
+        """在事件循環上複製要備份的記憶：[(user_id, 記憶數據, 版本, 清除次數)]"""
         
+        if not hasattr(memory_manager, 'short_term_memory'):
+            print("記憶管理器結構異常，跳過備份")
+            return None
+        
+        snapshot = []
+        for user_id in list(memory_manager.short_term_memory.keys()):
+            if only_dirty and not self.is_memory_dirty(user_id):
+                continue
+            entry = self._snapshot_user_memory(memory_manager, user_id)
+            if entry:
+                snapshot.append(entry)
+        return snapshot
+
+    def _snapshot_user_memory(self, memory_manager: Any, user_id: int) -> Optional[tuple]:
+        version = self._memory_versions.get(user_id, 0)
+        memory_data = self._extract_memory_data(memory_manager, user_id)
+        if not memory_data:
+            return None
+        return user_id, memory_data, version, self._clear_counts.get(user_id, 0)
+
+    def _write_memory_snapshot(self, snapshot: list, throttle: Optional[WriteThrottle] = None,
+                               cycle: bool = False) -> bool:
+        """寫入記憶快照；回傳是否每位用戶都寫入成功"""
         try:
-            if not hasattr(memory_manager, 'short_term_memory'):
-                print("記憶管理器結構異常，跳過備份")
-                return
-                
             # 遍歷所有用戶並保存其記憶
             saved_count = 0
-            for user_id in memory_manager.short_term_memory.keys():
-                memory_data = self._extract_memory_data(memory_manager, user_id)
-                if memory_data:
-                    self.save_user_memory(user_id, memory_data)
-                    saved_count += 1
+            for chunk in self._write_chunks(snapshot, throttle):
+                with self._chunk_batch(throttle):
+                    for entry in chunk:
+                        if throttle and not throttle.acquire():
+                            break
+                        written = self.storage.bytes_written
+                        if self._save_memory_snapshot(*entry, throttle, cycle):
+                            saved_count += 1
+                        if throttle:
+                            throttle.record(1, self.storage.bytes_written - written)
+                if throttle and throttle.cancelled:
+                    break
             
             print(f"記憶系統備份完成 - 已備份 {saved_count} 位用戶的記憶")
+            return saved_count == len(snapshot)
             
         except Exception as e:
             print(f"保存記憶系統時發生錯誤: {e}")
+            return False
+
+    async def flush_user_memories(self, memory_manager: Any, user_ids: list) -> list:
+        """移出記憶體前保存多位用戶的記憶，回傳已經沒有未保存變動、可以移出的用戶
+
+        快照在事件循環上取得，寫入交給工作執行緒；寫入期間又有新訊息的用戶仍是 dirty，不會被移出。
+        """
+        entries = []
+        for user_id in user_ids:
+            if self.is_memory_dirty(user_id):
+                entry = self._snapshot_user_memory(memory_manager, user_id)
+                if entry:
+                    entries.append(entry)
+        
+        if entries:
+            await asyncio.to_thread(self._save_entries, self._save_memory_snapshot, entries)
+        return [user_id for user_id in user_ids if not self.is_memory_dirty(user_id)]
+
+    def _save_entries(self, save: Callable[..., bool], entries: list) -> None:
+        """逐一寫入（在工作執行緒執行）；每位用戶各自持有存儲鎖，事件循環最多等一位用戶"""
+        for entry in entries:
+            save(*entry)
+
+    def _save_memory_snapshot(self, user_id: int, memory_data: Dict, version: int, clear_count: int,
+                              throttle: Optional[WriteThrottle] = None, cycle: bool = False) -> bool:
+        with self._storage_lock:
+            if self._clear_counts.get(user_id, 0) != clear_count:
+                return False  # 快照之後用戶已被清除
+            if throttle and throttle.cancelled:
+                return False  # 最終備份已接手，不可用舊快照覆蓋
+            if cycle and user_id not in self._cycle_memory_pending:
+                return True   # 期間已寫入較新的資料
+            
+            if not self.save_user_memory(user_id, memory_data):
+                return False
+            self._record_saved(self._memory_versions, self._memory_saved_versions, user_id, version)
+            self._cycle_memory_pending.discard(user_id)
+            return True
 
     def _extract_memory_data(self, memory_manager: Any, user_id: int) -> Optional[Dict]:
-        """提取用戶記憶數據"""
+        """提取用戶記憶數據的快照（序列化留給寫入端）"""
         
         try:
             if user_id not in memory_manager.short_term_memory:
                 return None
                 
-            memory_data = {
+            return {
                 "user_id": user_id,
                 "last_updated": datetime.datetime.now(self.taiwan_tz).isoformat(),
                 "short_term": list(memory_manager.short_term_memory[user_id]),
-                "important": memory_manager.important_memory.get(user_id, []),
-                "profile": memory_manager.user_profiles.get(user_id, {}),
+                "important": list(memory_manager.important_memory.get(user_id, [])),
+                # 檔案裡的列表會被就地修改，需要深複製（資料量很小）
+                "profile": copy.deepcopy(memory_manager.user_profiles.get(user_id, {})),
                 "conversation_summaries": memory_manager.conversation_summaries.get(user_id, ""),
                 "version": "2.0"  # 版本標識
             }
             
-            # 確保所有數據都是可序列化的
-            memory_data = self._make_serializable(memory_data)
-            return memory_data
-            
         except Exception as e:
             print(f"提取用戶 {user_id} 記憶數據失敗: {e}")
             return None
 
-    def save_user_memory(self, user_id: int, memory_data: Dict) -> None:
-        """保存單個用戶的記憶數據"""
+    def save_user_memory(self, user_id: int, memory_data: Dict) -> bool:
+        """保存單個用戶的記憶數據；內容與上次保存的摘要相同時不寫入"""
         
-        # 保存新的JSON檔案
-        memory_file = Path(self.memory_directory) / f"memory_{user_id}.json"
         try:
-            with open(memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, ensure_ascii=False, indent=2)
+            digest = serialization.digest(memory_data, serialization.MEMORY_VOLATILE_FIELDS)
+            if digest == self.storage.memory_digest(user_id):
+                print(f"用戶 {user_id} 的記憶內容沒有改變，略過寫入")
+                return True
+            
+            self.storage.save_memory(user_id, memory_data, digest)
             print(f"已保存用戶 {user_id} 的記憶數據")
+            return True
             
         except Exception as e:
             print(f"保存用戶 {user_id} 記憶失敗: {e}")
+            return False
 
     def load_user_memory(self, user_id: int) -> Optional[Dict]:
         """載入單個用戶的記憶數據"""
         
-        json_file = Path(self.memory_directory) / f"memory_{user_id}.json"
-        if json_file.exists():
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    memory_data = json.load(f)
-                print(f"已載入用戶 {user_id} 的記憶數據")
-                return memory_data
-            except Exception as e:
-                print(f"載入用戶 {user_id} 記憶失敗: {e}")
-    
-        return None
+        try:
+            memory_data = self.storage.load_memory(user_id)
+        except Exception as e:
+            print(f"載入用戶 {user_id} 記憶失敗: {e}")
+            return None
+        
+        if memory_data is not None:
+            print(f"已載入用戶 {user_id} 的記憶數據")
+            self._verify_memory_digest(user_id, memory_data)
+        return memory_data
+
+    def _verify_memory_digest(self, user_id: int, memory_data: Dict) -> None:
+        """比對讀回的內容與保存時記下的摘要；讀檔時順便檢查，不必另外掃描"""
+        
+        try:
+            expected = self.storage.memory_digest(user_id)
+            if expected and serialization.digest(memory_data, serialization.MEMORY_VOLATILE_FIELDS) != expected:
+                # 檔案被改動或寫入後當機；下次保存時會整份重寫
+                print(f"⚠️ 用戶 {user_id} 的記憶備份與索引摘要不符")
+        except Exception as e:
+            print(f"檢查用戶 {user_id} 記憶摘要失敗: {e}")
 
     def clear_user_memory_storage(self, user_id: int) -> None:
         """清除用戶的記憶存儲"""
 
-        all_memory = []
-        abs_path = os.path.abspath(self.memory_directory)
-        if not os.path.exists(abs_path): return
-    
-        for filename in os.listdir(abs_path):
-            if filename.startswith(f"memory_{user_id}") and filename.endswith(".json"):
-                filepath = os.path.join(abs_path, filename)
-                all_memory.append(filepath)
-            else: continue
-            
-        if not all_memory: 
-            print(f"用戶 {user_id} 沒有可刪除的舊記憶")
-            return
-
-        for old_memory_path in all_memory:
+        with self._storage_lock:
+            self._mark_cleared(user_id)
             try:
-                os.remove(old_memory_path)
-                print(f"  - 已刪除舊記憶{os.path.basename(old_memory_path)}")
-    
-            except OSError as e:
-                print(f"  - 無法刪除舊記憶 {os.path.basename(old_memory_path)}: {e}")
-          
-        
+                if not self.storage.delete_memory(user_id):
+                    print(f"用戶 {user_id} 沒有可刪除的舊記憶")
+            except Exception as e:
+                print(f"  - 無法刪除用戶 {user_id} 的舊記憶: {e}")
 
     # ==================== 工具方法 ====================
     
-    def _make_serializable(self, obj: Any) -> Any:
-        """遞歸地將物件轉換為可JSON序列化的格式"""
-        
-        if isinstance(obj, dict):
-            return {key: self._make_serializable(value) for key, value in obj.items()}
-        elif isinstance(obj, (list, tuple)):
-            return [self._make_serializable(item) for item in obj]
-        elif isinstance(obj, deque):
-            return list(obj)
-        elif isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        elif isinstance(obj, (str, int, float, bool)) or obj is None:
-            return obj
-        else:
-            # 嘗試轉換為字符串
-            try:
-                return str(obj)
-            except:
-                return f"<不可序列化物件: {type(obj).__name__}>"
-
     def get_latest_chat_timestamp(self, user_id: int) -> Optional[datetime.datetime]:
         """獲取用戶最新聊天備份時間"""
         
-        abs_path = os.path.abspath(self.backup_directory)
+        try:
+            timestamp = self.storage.latest_chat_time(user_id)
+        except Exception as e:
+            print(f"讀取用戶 {user_id} 備份時間時發生錯誤: {e}")
+            return None
         
-        if not os.path.exists(abs_path):
+        if timestamp is None:
             return None
-
-        latest_timestamp = None
-
-        for filename in os.listdir(abs_path):
-            if filename.startswith(f"chat_backup_{user_id}_") and filename.endswith(".json"):
-                try:
-                    parts = filename.split('_')
-                    if len(parts) >= 6:
-                        timestamp_str = f"{parts[3]}_{parts[4]}_{parts[5].split('.')[0]}"
-                        current_timestamp = datetime.datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S_%f")
-                        if latest_timestamp is None or current_timestamp > latest_timestamp:
-                            latest_timestamp = current_timestamp
-                except Exception as e:
-                    print(f"解析備份檔 {filename} 時間時發生錯誤: {e}")
-
-        return latest_timestamp
+        return datetime.datetime.fromtimestamp(timestamp, self.taiwan_tz)
 
     def get_backup_stats(self) -> Dict[str, Any]:
         """獲取備份統計信息"""
-        stats = {
-            "chat_backup_count": 0,
-            "memory_backup_count": 0,
-            "total_users": set(),
-            "memory_count": 0,
-            "latest_backup": None
-        }
-        
-        # 統計聊天備份
-        abs_backup_path = os.path.abspath(self.backup_directory)
-        if os.path.exists(abs_backup_path):
-            for filename in os.listdir(abs_backup_path):
-                if filename.startswith('chat_backup_') and filename.endswith('.json'):
-                    stats["chat_backup_count"] += 1
-                    try:
-                        parts = filename.split('_')
-                        if len(parts) >= 3:
-                            user_id = int(parts[2])
-                            stats["total_users"].add(user_id)
-                    except:
-                        pass
-        
-        # 統計記憶備份
-        abs_memory_path = os.path.abspath(self.memory_directory)
-        if os.path.exists(abs_memory_path):
-            for filename in os.listdir(abs_memory_path):
-                if filename.startswith('memory_'):
-                    stats["memory_count"] += 1
-                    stats["memory_backup_count"] += 1
-                    try:
-                        user_id = int(filename.split('_')[1].split('.')[0])
-                        stats["total_users"].add(user_id)
-                    except:
-                        pass
-        
-        stats["total_users"] = len(stats["total_users"])
+        stats = self.storage.stats()
+        if stats.get("latest_backup") is not None:
+            stats["latest_backup"] = datetime.datetime.fromtimestamp(stats["latest_backup"], self.taiwan_tz)
+        stats["backend"] = self.storage.name
         return stats
 
+    def close(self) -> None:
+        """關閉預寫日誌與存儲後端"""
+        self.closed = True
+        if self.wal:
+            self.wal.close()
+            self.wal = None
+        self.storage.close()
+
+# ==================== 共用實例 ====================
+
+_backup_manager: Optional[BackupManager] = None
+_backup_manager_lock = threading.Lock()
+
+
+def get_backup_manager(backup_directory: str = "chat_backups",
+                       memory_directory: str = "joy_memory") -> BackupManager:
+    """取得全程式共用的備份管理器，第一次呼叫時才建立；關閉後再呼叫會重新建立
+
+    Talking 與 ManualBackup 等都透過這裡取得同一個實例，
+    變動追蹤、預寫日誌與存儲連線只有一份。
+    """
+    global _backup_manager
+    with _backup_manager_lock:
+        if _backup_manager is None or _backup_manager.closed:
+            _backup_manager = BackupManager(backup_directory, memory_directory)
+        return _backup_manager
+
+
 # ==================== 兼容性函數 ====================
 
-# 創建全局備份管理器實例
-_backup_manager = BackupManager()
+@contextmanager
+def _compat_manager(backup_directory: str):
+    """指定目錄與共用實例相同時直接使用共用實例，否則建立一個臨時的"""
+    shared = get_backup_manager()
+    if os.path.abspath(backup_directory) == os.path.abspath(shared.backup_directory):
+        yield shared
+        return
+    
+    manager = BackupManager(backup_directory, shared.memory_directory)
+    try:
+        yield manager
+    finally:
+        manager.close()
 
 def delete_old_backups(user_id: int, backup_directory: str = "chat_backups"):
     """兼容性函數 - 刪除舊備份"""
-    global _backup_manager
-    if backup_directory != _backup_manager.backup_directory:
-        _backup_manager.backup_directory = backup_directory
-    _backup_manager.delete_old_chat_backups(user_id)
+    with _compat_manager(backup_directory) as manager:
+        manager.delete_old_chat_backups(user_id)
 
 def save_chat_history(message_history_data: dict, backup_directory: str = "chat_backups"):
     """兼容性函數 - 保存聊天歷史"""
-    global _backup_manager
-    if backup_directory != _backup_manager.backup_directory:
-        _backup_manager.backup_directory = backup_directory
-    _backup_manager.save_chat_history(message_history_data)
+    with _compat_manager(backup_directory) as manager:
+        manager.save_chat_history(message_history_data, only_dirty=False)
 
 def load_chat_history(backup_directory: str = "chat_backups") -> dict:
     """兼容性函數 - 載入聊天歷史"""
-    global _backup_manager
-    if backup_directory != _backup_manager.backup_directory:
-        _backup_manager.backup_directory = backup_directory
-    return _backup_manager.load_chat_history()
+    with _compat_manager(backup_directory) as manager:
+        return manager.load_chat_history()
 
 def get_latest_timestamp(user_id: int, backup_directory: str) -> Optional[datetime.datetime]:
     """兼容性函數 - 獲取最新時間戳"""
-    global _backup_manager
-    if backup_directory != _backup_manager.backup_directory:
-        _backup_manager.backup_directory = backup_directory
-    return _backup_manager.get_latest_chat_timestamp(user_id)
+    with _compat_manager(backup_directory) as manager:
+        return manager.get_latest_chat_timestamp(user_id)
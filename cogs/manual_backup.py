@@ -5,14 +5,18 @@ import os
 import datetime
 import pytz
 
-from chat_backup_manager import BackupManager
+from chat_backup_manager import BackupManager, get_backup_manager
+from message_record import Sender
 
 class ManualBackup(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.taiwan_tz = pytz.timezone('Asia/Taipei')
-        # 初始化備份管理器（與主系統使用相同的目錄）
-        self.backup_manager = BackupManager("chat_backups", "joy_memory")
+
+    @property
+    def backup_manager(self) -> BackupManager:
+        """與 Talking 共用同一個備份管理器（Talking 重新載入後也會拿到新的實例）"""
+        return get_backup_manager("chat_backups", "joy_memory")
 
     @app_commands.command(name="手動備份對話", description="備份你跟機器人的騷話")
     async def manual_backup(self, interaction: discord.Interaction):
@@ -29,16 +33,20 @@ class ManualBackup(commands.Cog):
                 await interaction.followup.send(embed=embed)
                 return
 
-            # 獲取用戶的聊天記錄數量
+            # 獲取用戶的聊天記錄數量（延遲載入模式下先從備份載入）
             user_id = interaction.user.id
+            await talking_cog._ensure_history_loaded(user_id)
             user_history = talking_cog.message_history.get(user_id, [])
             message_count = len(user_history)
 
-            # 使用統一備份管理器執行備份
-            await self.backup_manager.perform_backup(
-                talking_cog.message_history, 
+            # 只備份這位用戶；連續點擊會共用同一次寫入
+            saved = await self.backup_manager.backup_user(
+                user_id,
+                user_history,
                 talking_cog.memory_manager if hasattr(talking_cog, 'memory_manager') else None
             )
+            if not saved:
+                raise RuntimeError("寫入備份失敗")
 
             # 創建成功的回應嵌入
             embed = Embed(
@@ -122,6 +130,7 @@ class ManualBackup(commands.Cog):
             )
 
         # 獲取用戶聊天歷史
+        await talking_cog._ensure_history_loaded(user_id)
         user_history = talking_cog.message_history.get(user_id, [])
         last_user_msg = "無"
         last_bot_msg = "無"
@@ -129,10 +138,10 @@ class ManualBackup(commands.Cog):
         if user_history:
             # 找最後的用戶訊息和機器人回覆
             for message in reversed(user_history):
-                if message["sender"] == "user" and last_user_msg == "無":
-                    last_user_msg = message["content"]
-                elif message["sender"] == "bot" and last_bot_msg == "無":
-                    last_bot_msg = message["content"]
+                if message.sender is Sender.USER and last_user_msg == "無":
+                    last_user_msg = message.content
+                elif message.sender is Sender.BOT and last_bot_msg == "無":
+                    last_bot_msg = message.content
                 
                 if last_user_msg != "無" and last_bot_msg != "無":
                     break
@@ -159,13 +168,12 @@ class ManualBackup(commands.Cog):
                 inline=False
             )
 
-        # 計算下次定期備份時間
         now = datetime.datetime.now(self.taiwan_tz)
-        next_backup_time = self._calculate_next_backup_time(now)
 
+        # 下次定期備份時間（間隔依訊息量自動調整並有隨機浮動，以備份循環排定的時間為準）
         embed.add_field(
             name="下次定期備份時間 ⏰",
-            value=f"```\n{next_backup_time.strftime('%Y-%m-%d %H:%M:%S')}\n```",
+            value=f"```\n{self._describe_next_backup()}\n```",
             inline=False
         )
 
@@ -345,18 +353,15 @@ class ManualBackup(commands.Cog):
             return message
         return message[:max_length - 3] + "..."
 
-    def _calculate_next_backup_time(self, current_time: datetime.datetime) -> datetime.datetime:
-        """計算下次備份時間（每15分鐘一次）"""
-        backup_minutes = [0, 15, 30, 45]
-        
-        for minute in backup_minutes:
-            potential_time = current_time.replace(minute=minute, second=0, microsecond=0)
-            if potential_time > current_time:
-                return potential_time
-        
-        # 如果當前小時內沒有下次備份時間，則返回下一小時的00分
-        next_hour_time = current_time.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
-        return next_hour_time
+    def _describe_next_backup(self) -> str:
+        """備份循環排定的下一次備份時間與目前間隔"""
+        manager = self.backup_manager
+        if manager.backup_interval_minutes is None:
+            return "定時備份未啟動"
+        interval = f"目前間隔約 {manager.backup_interval_minutes:.0f} 分鐘"
+        if manager.next_backup_time is None:
+            return f"備份進行中（{interval}）"
+        return f"{manager.next_backup_time.strftime('%Y-%m-%d %H:%M:%S')}（{interval}）"
 
 
 async def setup(bot):
@@ -6,15 +6,23 @@ import os
 import google.generativeai as genai
 from bs4 import BeautifulSoup
 from google.generativeai.types import BlockedPromptException
-import datetime
 import pytz
 import json
 import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
 
 # 導入我們的記憶管理模組
-from memory_manager import JoyMemoryManager
+from memory_manager import JoyMemoryManager, select_idle_users
 # 導入統一備份管理器
-from chat_backup_manager import BackupManager
+from chat_backup_manager import MAX_HISTORY_LENGTH, get_backup_manager
+# 導入非同步 LLM 客戶端
+from llm_client import GeminiClient
+from context_builder import estimate_tokens
+from message_record import MessageRecord, to_record
+from message_wal import unpersisted_messages
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=GEMINI_API_KEY)
@@ -22,7 +30,19 @@ model = genai.GenerativeModel('models/gemini-2.5-flash')
 
 GENERATION_CONFIG = json.loads(os.getenv("GENERATION_CONFIG_JSON", '{}'))
 SAFETY = json.loads(os.getenv("SAFETY_JSON", '[]'))
-MAX_HISTORY_LENGTH = 500
+MAX_REPLY_LENGTH = 600
+# 串流回覆：邊生成邊編輯訊息，編輯間隔需低於Discord的速率限制
+STREAMING_REPLIES = os.getenv("STREAMING_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+# 閒置用戶移出記憶體：閒置秒數、常駐用戶上限、檢查間隔（秒）
+IDLE_USER_TTL = float(os.getenv("IDLE_USER_TTL_SECONDS", "1800"))
+MAX_RESIDENT_USERS = int(os.getenv("MAX_RESIDENT_USERS", "500"))
+EVICTION_CHECK_INTERVAL = float(os.getenv("EVICTION_CHECK_INTERVAL", "300"))
+# 啟動時預先載入記憶的近期活躍用戶數
+PREFETCH_RECENT_USERS = int(os.getenv("PREFETCH_RECENT_USERS", "50"))
+# 聊天歷史載入模式：lazy（只讀索引，第一次對話時才載入）、parallel（背景執行緒池並行載入）、eager（啟動時全部載入）
+HISTORY_LOAD_MODE = os.getenv("HISTORY_LOAD_MODE", "lazy").lower()
+HISTORY_LOAD_WORKERS = int(os.getenv("HISTORY_LOAD_WORKERS", "8"))
 
 intents = discord.Intents.all()
 
@@ -32,11 +52,23 @@ class Talking(commands.Cog):
         self.bot = bot
         self.message_history = {}  # 保留原始歷史記錄用於兼容性
         
-        # 初始化統一備份管理器
-        self.backup_manager = BackupManager("chat_backups", "joy_memory")
+        # 每位用戶的待處理訊息與處理任務（確保同一用戶依序回應）
+        self._pending_turns = {}  # user_id -> [(message, content)]
+        self._turn_tasks = {}     # user_id -> asyncio.Task
         
-        # 初始化記憶管理系統，傳入備份管理器引用
-        self.memory_manager = JoyMemoryManager("joy_memory", self.backup_manager)
+        # 聊天歷史的最近活動時間（由舊到新）
+        self._history_last_active = OrderedDict()  # user_id -> monotonic time
+        self._history_loading = {}  # user_id -> asyncio.Task
+        self._history_load_task = None  # parallel 模式的背景載入任務
+        
+        # 取得共用的統一備份管理器
+        self.backup_manager = get_backup_manager("chat_backups", "joy_memory")
+        
+        # 非阻塞的 Gemini 客戶端（並行上限與逾時由環境變數設定）
+        self.llm_client = GeminiClient(model, GENERATION_CONFIG, SAFETY)
+        
+        # 初始化記憶管理系統，傳入備份管理器引用；摘要與回覆共用同一個客戶端與並行上限
+        self.memory_manager = JoyMemoryManager("joy_memory", self.backup_manager, self.llm_client)
         
         self.role_prompt = os.getenv("ROLE_PROMPT_BASE")
         self.taiwan_tz = pytz.timezone('Asia/taipei')
@@ -44,16 +76,42 @@ class Talking(commands.Cog):
         # 從備份載入歷史記錄
         self._load_existing_data()
         
+        # 重播上次當機前尚未備份的訊息，之後每則訊息都先寫入預寫日誌
+        self._replay_message_wal()
+        
         # 啟動定時備份任務
         self._start_backup_system()
+        
+        # 定期把閒置用戶移出記憶體
+        self.evict_idle_users_task.start()
+        
+        # 背景預先載入近期活躍用戶的記憶
+        self._prefetch_task = asyncio.create_task(self._prefetch_recent_users())
 
     def _load_existing_data(self):
-        """載入現有的數據"""
+        """依 HISTORY_LOAD_MODE 載入現有的數據"""
+        
+        if HISTORY_LOAD_MODE == "lazy":
+            # 只讀索引；歷史在用戶第一次對話時由 _ensure_history_loaded 載入
+            user_count = len(self.backup_manager.get_chat_users())
+            print(f"聊天歷史延遲載入：索引中有 {user_count} 位用戶")
+            return
+        
+        if HISTORY_LOAD_MODE == "parallel":
+            self._history_load_task = asyncio.create_task(self._load_histories_parallel())
+            return
+        
         try:
             # 載入聊天歷史
             loaded_history = self.backup_manager.load_chat_history()
             if loaded_history:
-                self.message_history = loaded_history
+                self.message_history = {
+                    user_id: [to_record(message) for message in history]
+                    for user_id, history in loaded_history.items()
+                }
+                loaded_at = time.monotonic()
+                for user_id in self.message_history:
+                    self._history_last_active[user_id] = loaded_at
                 print(f"已載入 {len(loaded_history)} 個用戶的聊天歷史")
             else:
                 print("沒有找到現有的聊天歷史")
@@ -61,6 +119,67 @@ class Talking(commands.Cog):
         except Exception as e:
             print(f"載入數據時發生錯誤: {e}")
 
+    def _replay_message_wal(self):
+        """把預寫日誌中的訊息補回聊天歷史與記憶系統"""
+        try:
+            replayed = self.backup_manager.open_wal()
+        except Exception as e:
+            print(f"開啟預寫日誌失敗，本次執行不記錄預寫日誌: {e}")
+            return
+        
+        for user_id, records in replayed.items():
+            try:
+                self.memory_manager.replay_messages(user_id, records)
+                
+                if user_id not in self.message_history:
+                    self.message_history[user_id] = [
+                        to_record(message)
+                        for message in self.backup_manager.load_user_chat_history(user_id) or []
+                    ]
+                for record in unpersisted_messages(self.message_history[user_id], records):
+                    self.update_message_history(user_id, record.content, record.sender.label, record)
+            except Exception as e:
+                print(f"重播用戶 {user_id} 的預寫日誌失敗: {e}")
+
+    async def _load_histories_parallel(self):
+        """在背景以執行緒池並行載入所有聊天歷史，不阻塞啟動"""
+        try:
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            loaded_history = await loop.run_in_executor(
+                None, self.backup_manager.load_chat_history, HISTORY_LOAD_WORKERS
+            )
+            
+            loaded_at = time.monotonic()
+            merged = 0
+            for user_id, history in loaded_history.items():
+                # 載入期間已經開始對話的用戶以記憶體中的為準
+                if user_id in self.message_history:
+                    continue
+                self.message_history[user_id] = history
+                self._history_last_active[user_id] = loaded_at
+                self._history_last_active.move_to_end(user_id, last=False)
+                merged += 1
+            print(f"已並行載入 {merged} 個用戶的聊天歷史，耗時 {loaded_at - started:.2f} 秒")
+        except Exception as e:
+            print(f"並行載入聊天歷史失敗: {e}")
+
+    async def _prefetch_recent_users(self):
+        """在執行緒池中讀取近期活躍用戶的記憶，讓他們的第一則訊息不必等磁碟"""
+        try:
+            loop = asyncio.get_running_loop()
+            user_ids = await loop.run_in_executor(
+                None, self.backup_manager.get_recent_chat_users, PREFETCH_RECENT_USERS
+            )
+            loaded = await self.memory_manager.prefetch_users(user_ids)
+            print(f"已預先載入 {loaded} 位近期活躍用戶的記憶")
+            
+            if HISTORY_LOAD_MODE == "lazy":
+                # 延遲載入模式下也預先載入他們的聊天歷史
+                await asyncio.gather(*(self._ensure_history_loaded(user_id) for user_id in user_ids))
+        except Exception as e:
+            print(f"預先載入用戶記憶失敗: {e}")
+
     def _start_backup_system(self):
         """啟動備份系統"""
         try:
@@ -73,6 +192,12 @@ class Talking(commands.Cog):
             print("統一備份系統已啟動")
         except Exception as e:
             print(f"啟動備份系統失敗: {e}")
+        
+        try:
+            # 摘要改由背景工作者處理，回覆流程不等待
+            self.memory_manager.start_summary_worker()
+        except Exception as e:
+            print(f"啟動背景摘要失敗: {e}")
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -86,11 +211,27 @@ class Talking(commands.Cog):
         """Cog卸載時的清理工作"""
         print("\n喬伊記憶系統正在卸載...")
         
-        # 停止備份循環
+        # 停止備份循環與背景摘要
         self.backup_manager.stop_backup_loop()
+        self.memory_manager.stop_summary_worker()
+        
+        self.evict_idle_users_task.cancel()
+        self._prefetch_task.cancel()
+        if self._history_load_task:
+            self._history_load_task.cancel()
+        
+        # 取消尚未完成的對話回合
+        for task in list(self._turn_tasks.values()):
+            task.cancel()
+        self._turn_tasks.clear()
+        self._pending_turns.clear()
         
         # 執行最後一次備份
         self.backup_manager.final_backup(self.message_history, self.memory_manager)
+        self.backup_manager.close()
+        
+        # 釋放 LLM 客戶端資源
+        self.llm_client.close()
         
         print("喬伊記憶系統已安全卸載\n")
 
@@ -116,95 +257,258 @@ class Talking(commands.Cog):
             if "得卡" in content: 
                 return
 
-            # 正常對話處理
-            async with message.channel.typing():
-                user_id = message.author.id
-                
-                # 更新記憶系統
-                self._update_both_histories(user_id, content, "user")
+            # 正常對話處理：同一用戶在生成期間送來的連續訊息合併成一次回應
+            self._enqueue_turn(message, content)
+
+    def _enqueue_turn(self, message: discord.Message, content: str):
+        """將訊息排入該用戶的待處理佇列，每位用戶同時只有一個處理任務"""
+        
+        user_id = message.author.id
+        self._pending_turns.setdefault(user_id, []).append((message, content))
+        
+        task = self._turn_tasks.get(user_id)
+        if task is None or task.done():
+            self._turn_tasks[user_id] = asyncio.create_task(self._process_user_turns(user_id))
+
+    async def _process_user_turns(self, user_id: int):
+        """依序處理用戶的對話回合，生成期間新到的訊息併入下一回合
+
+        第一則訊息立即開始生成，不額外等待；只有上一回合生成期間陸續送來的訊息才會合併。
+        """
+        
+        try:
+            while True:
+                batch = self._pending_turns.pop(user_id, [])
+                if not batch:
+                    break
                 
-                # 獲取智能上下文
-                context = self.memory_manager.get_context_for_response(user_id)
+                message = batch[-1][0]
+                content = "\n".join(text for _, text in batch)
+                if len(batch) > 1:
+                    print(f"用戶 {user_id} 的 {len(batch)} 則訊息已合併為一次回應")
                 
-                # 生成回應
+                try:
+                    await self._respond_to_turn(message, user_id, content)
+                except Exception as e:
+                    print(f"處理用戶 {user_id} 的對話時發生錯誤: {e}")
+        finally:
+            if self._turn_tasks.get(user_id) is asyncio.current_task():
+                del self._turn_tasks[user_id]
+
+    async def _respond_to_turn(self, message: discord.Message, user_id: int, content: str):
+        """處理單一對話回合：更新記憶、生成並送出回應"""
+        
+        async with message.channel.typing():
+            # 磁碟讀取在執行緒池進行，不阻塞其他用戶
+            await self.memory_manager.ensure_user_loaded(user_id)
+            await self._ensure_history_loaded(user_id)
+            
+            # 更新記憶系統
+            self._update_both_histories(user_id, content, "user")
+            
+            # 獲取智能上下文
+            context = self.memory_manager.get_context_for_response(user_id, self.llm_client.model_name)
+            
+            # 生成回應（串流模式會邊生成邊編輯回覆）
+            if STREAMING_REPLIES:
+                response_content = await self.stream_response_with_context(message, context)
+            else:
                 response_content = await self.generate_response_with_context(context)
                 
                 if response_content and response_content.strip():
                     # 檢查回應長度，避免超過Discord限制
-                    if len(response_content) > 600:
-                        response_content = response_content[:600] + "..."
-                    
-                    response_text = f"```\n{response_content}\n```"
-                    await message.reply(response_text)
-                    
-                    # 記錄回應到記憶
-                    self._update_both_histories(user_id, response_content, "bot")
-                else:
-                    fallback_response = "訓練員，我現在有點暈暈的，稍等一下再跟我說話好嗎？"
-                    await message.reply(fallback_response)
-                    print(f"Gemini API 回傳空字串，使用者ID: {user_id}")
+                    response_content = self._apply_length_policy(response_content)
+                    await message.reply(self._format_reply(response_content))
+            
+            if response_content and response_content.strip():
+                # 記錄回應到記憶
+                self._update_both_histories(user_id, response_content, "bot")
+            else:
+                fallback_response = "訓練員，我現在有點暈暈的，稍等一下再跟我說話好嗎？"
+                await message.reply(fallback_response)
+                print(f"Gemini API 回傳空字串，使用者ID: {user_id}")
 
     def _update_both_histories(self, user_id: int, content: str, sender: str):
         """同時更新原始歷史記錄和記憶管理系統"""
         
-        # 更新原始記錄（用於備份兼容性）
-        self.update_message_history(user_id, content, sender)
-        
         # 更新智能記憶系統
-        self.memory_manager.add_message(user_id, content, sender)
+        record = self.memory_manager.add_message(user_id, content, sender)
+        
+        # 更新原始記錄（與記憶系統共用同一筆訊息紀錄）
+        self.update_message_history(user_id, content, sender, record)
+        
+        # 寫入預寫日誌（背景群組提交），兩次備份之間當機也不會遺失
+        if self.backup_manager.wal:
+            self.backup_manager.wal.append(user_id, record)
+
+    def _build_prompt(self, context: str) -> str:
+        """構建完整prompt"""
+        full_prompt = f"""{self.role_prompt}{context}請根據以上記憶和對話記錄，以喬伊的身份自然回應："""
+
+        # 記錄prompt信息
+        prompt_length = len(full_prompt)
+        print(f"📝 Prompt長度: {prompt_length} 字符，約 {estimate_tokens(full_prompt)} tokens")
+        
+        return full_prompt
 
     async def generate_response_with_context(self, context: str) -> str:
         """使用上下文生成回應"""
         try:
-            # 構建prompt
-            full_prompt = f"""{self.role_prompt}{context}請根據以上記憶和對話記錄，以喬伊的身份自然回應："""
-
-            # 記錄prompt信息
-            prompt_length = len(full_prompt)
-            print(f"📝 Prompt長度: {prompt_length} 字符")
-            
-            # 調用API
-            response = model.generate_content(
-                full_prompt, 
-                generation_config=GENERATION_CONFIG, 
-                safety_settings=SAFETY
-            )
+            full_prompt = self._build_prompt(context)
             
-            gemini_text = response.text
+            # 調用API（不阻塞事件循環）
+            gemini_text = await self.llm_client.generate(full_prompt)
             
             if not gemini_text or not gemini_text.strip():
                 return "訓練員你有點抽象，不知道要說什麼、、、"
 
-            # 清理HTML標籤
-            if any(tag in gemini_text for tag in ['<div', '<p', '<br>', '<span']):
-                soup = BeautifulSoup(gemini_text, 'html.parser')
-                gemini_text = soup.get_text(separator=' ', strip=True)
-                gemini_text = ' '.join(gemini_text.split())
-
-            return gemini_text
+            return self._clean_response_text(gemini_text)
 
         except BlockedPromptException as e:
             print(f"內容被Gemini阻擋: {e}")
             return "訓練員，這個話題讓我有點害羞呢，換個話題好嗎？"
 
+        except asyncio.TimeoutError:
+            print(f"API調用逾時（{self.llm_client.timeout} 秒）")
+            return "訓練員，我想得太入迷了，可以再說一次嗎？"
+
         except Exception as e:
             print(f"API調用錯誤: {e}")
             return "訓練員，我的腦袋短路了一下，稍後再試試吧？"
 
-    def update_message_history(self, user_id: int, message_content: str, sender: str):
+    async def stream_response_with_context(self, message: discord.Message, context: str) -> str:
+        """串流生成回應，第一段文字到達就回覆，之後依固定節奏編輯訊息"""
+        raw_text = ""
+        shown = ""
+        reply_message = None
+        last_edit = 0.0
+        
+        stream = self.llm_client.stream(self._build_prompt(context))
+        try:
+            async for chunk in stream:
+                raw_text += chunk
+                content = self._apply_length_policy(self._clean_response_text(raw_text, partial=True))
+                
+                if content.strip():
+                    now = asyncio.get_running_loop().time()
+                    if reply_message is None:
+                        reply_message = await message.reply(self._format_reply(content))
+                        shown, last_edit = content, now
+                    elif content != shown and now - last_edit >= STREAM_EDIT_INTERVAL:
+                        shown, last_edit = await self._edit_reply(reply_message, content, shown), now
+                
+                # 已達長度上限，後面的內容不會顯示
+                if len(content) > MAX_REPLY_LENGTH:
+                    break
+                    
+        except BlockedPromptException as e:
+            print(f"內容被Gemini阻擋: {e}")
+            if reply_message is None:
+                raw_text = "訓練員，這個話題讓我有點害羞呢，換個話題好嗎？"
+
+        except asyncio.TimeoutError:
+            print(f"API串流逾時（{self.llm_client.timeout} 秒）")
+            if reply_message is None:
+                raw_text = "訓練員，我想得太入迷了，可以再說一次嗎？"
+
+        except Exception as e:
+            print(f"API調用錯誤: {e}")
+            if reply_message is None:
+                raw_text = "訓練員，我的腦袋短路了一下，稍後再試試吧？"
+                
+        finally:
+            await stream.aclose()
+        
+        if not raw_text.strip():
+            raw_text = "訓練員你有點抽象，不知道要說什麼、、、"
+        
+        # 最終內容以完整文字重新清理一次
+        final_content = self._apply_length_policy(self._clean_response_text(raw_text))
+        if not final_content.strip():
+            return ""
+        
+        if reply_message is None:
+            await message.reply(self._format_reply(final_content))
+        elif final_content != shown:
+            await self._edit_reply(reply_message, final_content, shown)
+        
+        return final_content
+
+    async def _edit_reply(self, reply_message: discord.Message, content: str, shown: str) -> str:
+        """編輯串流中的回覆，失敗時保留原本顯示的內容"""
+        try:
+            await reply_message.edit(content=self._format_reply(content))
+            return content
+        except discord.HTTPException as e:
+            print(f"編輯串流回覆失敗: {e}")
+            return shown
+
+    @staticmethod
+    def _clean_response_text(text: str, partial: bool = False) -> str:
+        """清理HTML標籤；partial 為 True 時先移除結尾尚未完整的標籤"""
+        if partial:
+            text = re.sub(r"<[^<>]*$", "", text)
+        
+        if any(tag in text for tag in ['<div', '<p', '<br>', '<span']):
+            soup = BeautifulSoup(text, 'html.parser')
+            text = soup.get_text(separator=' ', strip=True)
+            text = ' '.join(text.split())
+        
+        return text
+
+    @staticmethod
+    def _apply_length_policy(text: str) -> str:
+        """檢查回應長度，避免超過Discord限制"""
+        if len(text) > MAX_REPLY_LENGTH:
+            return text[:MAX_REPLY_LENGTH] + "..."
+        return text
+
+    @staticmethod
+    def _format_reply(content: str) -> str:
+        return f"```\n{content}\n```"
+
+    async def _ensure_history_loaded(self, user_id: int):
+        """確保用戶聊天歷史已在記憶體中；同一用戶的並行載入只讀一次檔案"""
+        
+        if user_id in self.message_history:
+            return
+        
+        task = self._history_loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load_history_async(user_id))
+            self._history_loading[user_id] = task
+            task.add_done_callback(lambda _: self._history_loading.pop(user_id, None))
+        
+        await asyncio.shield(task)
+
+    async def _load_history_async(self, user_id: int):
+        loop = asyncio.get_running_loop()
+        reloaded = await loop.run_in_executor(None, self.backup_manager.load_user_chat_history, user_id)
+        
+        if user_id not in self.message_history:
+            self.message_history[user_id] = [to_record(message) for message in reloaded or []]
+            self._history_last_active[user_id] = time.monotonic()
+            self._history_last_active.move_to_end(user_id)
+
+    def update_message_history(self, user_id: int, message_content: str, sender: str,
+                               record: Optional[MessageRecord] = None):
         """維護原始訊息歷史（用於備份相容性）"""
         
         user_obj = self.bot.get_user(user_id)
         
         if user_id not in self.message_history:
-            self.message_history[user_id] = []
-            print(f"用戶 {user_obj.name if user_obj else user_id} 的原始歷史已初始化")
+            # 被移出記憶體的用戶從備份重新載入
+            reloaded = self.backup_manager.load_user_chat_history(user_id)
+            if reloaded:
+                self.message_history[user_id] = [to_record(message) for message in reloaded]
+            else:
+                self.message_history[user_id] = []
+                print(f"用戶 {user_obj.name if user_obj else user_id} 的原始歷史已初始化")
 
-        self.message_history[user_id].append({
-            "sender": sender,
-            "content": message_content,
-            "timestamp": datetime.datetime.now(self.taiwan_tz).isoformat("#", "seconds")
-        })
+        self.message_history[user_id].append(record or MessageRecord(message_content, sender))
+        self.backup_manager.mark_chat_dirty(user_id)
+        self._history_last_active[user_id] = time.monotonic()
+        self._history_last_active.move_to_end(user_id)
 
         # 維持長度限制
         if len(self.message_history[user_id]) >= MAX_HISTORY_LENGTH:
@@ -213,6 +517,38 @@ class Talking(commands.Cog):
             self.message_history[user_id] = self.message_history[user_id][remove_count:]
             print(f"用戶 {user_obj.name if user_obj else user_id} 的歷史記錄已裁剪，移除 {remove_count} 條舊記錄")
 
+    # ==================== 閒置用戶移出 ====================
+
+    @tasks.loop(seconds=EVICTION_CHECK_INTERVAL)
+    async def evict_idle_users_task(self):
+        """把閒置用戶寫回磁碟並移出記憶體，常駐量只與活躍用戶數有關"""
+        
+        # 正在處理對話的用戶不移出
+        active_users = set(self._turn_tasks) | set(self._pending_turns)
+        
+        await self.memory_manager.evict_idle_users(IDLE_USER_TTL, MAX_RESIDENT_USERS, exclude=active_users)
+        await self._evict_idle_histories(active_users)
+
+    async def _evict_idle_histories(self, exclude: set):
+        """移出閒置用戶的聊天歷史，有變動的先寫回備份（寫入在工作執行緒進行）"""
+        
+        candidates = select_idle_users(self._history_last_active, IDLE_USER_TTL,
+                                       MAX_RESIDENT_USERS, exclude)
+        if not candidates:
+            return
+        
+        histories = {user_id: self.message_history.get(user_id) for user_id in candidates}
+        evicted = 0
+        for user_id in await self.backup_manager.flush_user_histories(histories):
+            if self._history_last_active.get(user_id) != candidates[user_id]:
+                continue  # 寫入期間又有新訊息
+            self.message_history.pop(user_id, None)
+            del self._history_last_active[user_id]
+            evicted += 1
+        
+        if evicted:
+            print(f"已將 {evicted} 位閒置用戶的聊天歷史移出記憶體")
+
     # ==================== 管理指令 ====================
     
     @app_commands.command(name="看透喬伊的小腦袋", description="查看記憶系統統計")
@@ -259,7 +595,9 @@ class Talking(commands.Cog):
         if user_id in self.message_history:
             del self.message_history[user_id]
             print(f"用戶 {user_id} 的聊天紀錄已刪除")
-            self.backup_manager.delete_old_chat_backups(user_id)
+        self._history_last_active.pop(user_id, None)
+        # 用戶可能已被移出記憶體，備份檔一律刪除
+        self.backup_manager.delete_old_chat_backups(user_id)
         
         # 清除備份存儲
         self.backup_manager.clear_user_memory_storage(user_id)
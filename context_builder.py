@@ -0,0 +1,159 @@
+import math
+import os
+import re
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+# 各模型的上下文 token 預算（只計算記憶上下文，不含角色提示詞）
+MODEL_TOKEN_BUDGETS = {
+    "models/gemini-2.5-flash": 3000,
+    "models/gemini-2.0-flash": 3000,
+}
+DEFAULT_TOKEN_BUDGET = 3000
+
+# 中日韓文字、全形標點大約一字一個 token；其他文字約四個字元一個 token
+_CJK_PATTERN = re.compile(
+    "[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff"
+    "\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+ASCII_CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文字的 token 數（CJK 感知）"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + math.ceil(other_count / ASCII_CHARS_PER_TOKEN)
+
+
+def get_token_budget(model_name: Optional[str] = None) -> int:
+    """取得模型的上下文預算，環境變數 CONTEXT_TOKEN_BUDGET 優先"""
+    override = os.getenv("CONTEXT_TOKEN_BUDGET")
+    if override:
+        return int(override)
+    return MODEL_TOKEN_BUDGETS.get(model_name or "", DEFAULT_TOKEN_BUDGET)
+
+
+class ContextSection:
+    """上下文的一個區段，內容以完整項目（整則訊息）為單位"""
+
+    __slots__ = ("title", "items", "item_tokens", "priority", "separator", "required", "max_share", "order")
+
+    def __init__(self, title: str, items: List[str], priority: int, separator: str = "；",
+                 required: bool = False, max_share: float = 1.0, order: int = 0,
+                 item_tokens: Optional[List[int]] = None):
+        self.title = title
+        self.items = items
+        self.item_tokens = item_tokens if item_tokens is not None else [estimate_tokens(item) for item in items]
+        self.priority = priority
+        self.separator = separator
+        self.required = required
+        self.max_share = max_share
+        self.order = order
+
+
+class ContextBuilder:
+    """依優先順序把各區段塞進 token 預算
+
+    優先度數字越小越先分配預算。每個區段從最新的項目往回挑，只收完整項目，
+    不會把訊息切成兩半；輸出時仍維持區段與項目原本的順序。
+    """
+
+    SECTION_SEPARATOR = "\n\n"
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self.sections: List[ContextSection] = []
+
+    def add_section(self, title: str, items: List[str], priority: int, separator: str = "；",
+                    required: bool = False, max_share: float = 1.0,
+                    item_tokens: Optional[List[int]] = None) -> None:
+        """新增區段；required 的區段無視預算一定保留，max_share 限制可佔預算的比例
+
+        item_tokens 可傳入已快取的每項 token 數，省去重新估算。
+        """
+        if items:
+            self.sections.append(ContextSection(title, items, priority, separator,
+                                                required, max_share, len(self.sections),
+                                                item_tokens))
+
+    def build(self) -> str:
+        """組合上下文字串"""
+        chosen: Dict[int, List[str]] = {}
+        remaining = self.token_budget
+        separator_cost = estimate_tokens(self.SECTION_SEPARATOR)
+
+        for section in sorted(self.sections, key=lambda s: s.priority):
+            if section.required:
+                chosen[section.order] = section.items
+                remaining -= estimate_tokens(self._render(section, section.items)) + separator_cost
+                continue
+
+            allowance = min(remaining, int(self.token_budget * section.max_share))
+            cost = estimate_tokens(section.title) + separator_cost
+            item_separator_cost = estimate_tokens(section.separator)
+            picked = []
+            for item, item_tokens in zip(reversed(section.items), reversed(section.item_tokens)):
+                item_cost = item_tokens + item_separator_cost
+                if cost + item_cost > allowance:
+                    break
+                picked.append(item)
+                cost += item_cost
+
+            if picked:
+                picked.reverse()
+                chosen[section.order] = picked
+                remaining -= cost
+
+        parts = [self._render(section, chosen[section.order])
+                 for section in self.sections if section.order in chosen]
+        return self.SECTION_SEPARATOR.join(parts)
+
+    @staticmethod
+    def _render(section: ContextSection, items: List[str]) -> str:
+        return section.title + section.separator.join(items)
+
+
+# 快取項目：(來源物件, 渲染後文字, token 數)
+CachedItem = Tuple[Any, str, int]
+
+
+class SegmentCache:
+    """單一用戶的已渲染上下文片段
+
+    一般區段以版本號判斷是否需要重新渲染；最近對話則維持一個滾動緩衝區，
+    新訊息進來時只渲染那一則。
+    """
+
+    __slots__ = ("_segments", "recent")
+
+    def __init__(self, recent_size: int):
+        self._segments: Dict[str, Tuple[Hashable, List[CachedItem]]] = {}
+        self.recent = deque(maxlen=recent_size)
+
+    def get(self, name: str, version: Hashable,
+            render: Callable[[], Iterable[Tuple[Any, str]]]) -> List[CachedItem]:
+        """取得區段內容，版本不同時才呼叫 render 重新渲染"""
+        cached = self._segments.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        items = [(source, text, estimate_tokens(text)) for source, text in render() if text]
+        self._segments[name] = (version, items)
+        return items
+
+    def append_recent(self, source: Any, text: str) -> None:
+        """把新訊息的渲染結果推入滾動緩衝區"""
+        self.recent.append((source, text, estimate_tokens(text)))
+
+    def get_recent(self, sources: Any, render: Callable[[Any], str]) -> List[CachedItem]:
+        """取得最近對話；緩衝區與實際訊息不一致（例如剛載入或清除）時整批重建"""
+        recent = self.recent
+        if (len(recent) != len(sources) or
+                (recent and (recent[0][0] is not sources[0] or recent[-1][0] is not sources[-1]))):
+            recent.clear()
+            for source in sources:
+                self.append_recent(source, render(source))
+        return list(recent)
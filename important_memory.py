@@ -0,0 +1,62 @@
+import heapq
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from message_record import MessageRecord
+
+
+class ImportantMemoryStore:
+    """單一用戶的重要記憶，容量固定、以最小堆積決定淘汰對象
+
+    淘汰順序依 (是否危險, 重要性, 加入順序)：非危險訊息先於危險訊息，
+    同類中重要性低、較舊的先淘汰。新增與淘汰皆為 O(log n)，
+    迭代時仍依加入順序（由舊到新）。
+    """
+
+    __slots__ = ("capacity", "_is_dangerous", "_heap", "_entries", "_seq")
+
+    def __init__(self, capacity: int, is_dangerous: Callable[[MessageRecord], bool],
+                 messages: Iterable[MessageRecord] = ()):
+        self.capacity = capacity
+        self._is_dangerous = is_dangerous
+        self._heap = []       # (is_dangerous, importance, seq)
+        self._entries = {}    # seq -> message，dict 保留插入順序
+        self._seq = 0
+
+        for message in messages:
+            self.append(message)
+
+    def append(self, message: MessageRecord) -> Optional[MessageRecord]:
+        """加入訊息；超過容量時回傳被淘汰的訊息"""
+        seq = self._seq
+        self._seq += 1
+
+        key = (self._is_dangerous(message), message.importance, seq)
+        self._entries[seq] = message
+
+        if len(self._entries) <= self.capacity:
+            heapq.heappush(self._heap, key)
+            return None
+
+        # 新訊息本身可能就是最該淘汰的，heappushpop 一次處理
+        evicted_key = heapq.heappushpop(self._heap, key)
+        return self._entries.pop(evicted_key[2])
+
+    def recent(self, count: int) -> List[MessageRecord]:
+        """最近加入的 count 則訊息（由舊到新）"""
+        messages = list(islice(reversed(self._entries.values()), count))
+        messages.reverse()
+        return messages
+
+    def clear(self) -> None:
+        self._heap.clear()
+        self._entries.clear()
+
+    def to_list(self) -> List[MessageRecord]:
+        return list(self._entries.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[MessageRecord]:
+        return iter(list(self._entries.values()))
@@ -0,0 +1,72 @@
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, List
+
+
+class KeywordMatcher:
+    """多關鍵詞比對器（Aho-Corasick 自動機）
+
+    建構時把所有分類的關鍵詞編進同一個自動機，之後每則訊息只需掃描一次，
+    即可得到命中的所有分類。
+    """
+
+    def __init__(self, categories: Dict[str, Iterable[str]], ignore_case: bool = True):
+        self.ignore_case = ignore_case
+
+        # 狀態 0 為根節點
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[FrozenSet[str]] = [frozenset()]
+
+        for category, keywords in categories.items():
+            for keyword in keywords:
+                if keyword:
+                    self._add_keyword(self._normalize(keyword), category)
+
+        self._build_failure_links()
+
+    def _normalize(self, text: str) -> str:
+        return text.lower() if self.ignore_case else text
+
+    def _add_keyword(self, keyword: str, category: str) -> None:
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(frozenset())
+            state = next_state
+        self._output[state] = self._output[state] | {category}
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+
+                # 合併後綴狀態的輸出，比對時不用再沿失敗鏈收集
+                self._output[next_state] = self._output[next_state] | self._output[self._fail[next_state]]
+
+    def match(self, text: str) -> FrozenSet[str]:
+        """回傳文字命中的所有分類"""
+        goto, fail, output = self._goto, self._fail, self._output
+        hits = frozenset()
+        state = 0
+
+        for char in self._normalize(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                hits = hits | output[state]
+
+        return hits
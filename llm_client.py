@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Optional
+
+# 同時進行中的 LLM 請求上限與單次請求逾時（秒）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+# 設為 1 時強制走執行緒池（例如原生非同步 API 不穩定時）
+LLM_FORCE_EXECUTOR = os.getenv("LLM_FORCE_EXECUTOR", "0") == "1"
+
+
+class GeminiClient:
+    """非阻塞的 Gemini 客戶端
+
+    優先使用 SDK 原生的 generate_content_async；若不可用則改用專屬的
+    有界執行緒池，避免同步呼叫卡住事件循環。所有請求共用同一個並行上限，
+    並各自套用逾時。呼叫端的 task 被取消時，等待中的請求也會一併取消。
+    """
+
+    def __init__(self, model: Any, generation_config: Optional[dict] = None,
+                 safety_settings: Optional[list] = None,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 timeout: float = LLM_TIMEOUT_SECONDS):
+        self.model = model
+        self.generation_config = generation_config or {}
+        self.safety_settings = safety_settings or []
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._use_native_async = (not LLM_FORCE_EXECUTOR and
+                                  hasattr(model, "generate_content_async"))
+        self._executor = None
+        if not self._use_native_async:
+            # 執行緒數與並行上限一致，逾時後殘留的執行緒也不會無限增加
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                                thread_name_prefix="gemini")
+
+    @property
+    def model_name(self) -> str:
+        """目前使用的模型名稱"""
+        return getattr(self.model, "model_name", "") or ""
+
+    async def generate(self, prompt: str, timeout: Optional[float] = None,
+                       model: Any = None) -> str:
+        """送出請求並回傳文字結果
+
+        model 可為單次請求指定其他模型（例如摘要用的較輕量模型），
+        仍共用同一個並行上限與執行緒池；省略時使用建構時的模型。
+        逾時會拋出 asyncio.TimeoutError；API 錯誤（例如 BlockedPromptException）
+        原樣拋出，由呼叫端決定回覆內容。
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        async with self._semaphore:
+            response = await asyncio.wait_for(self._call(prompt, model or self.model), timeout=timeout)
+        return response.text
+
+    async def _call(self, prompt: str, model: Any) -> Any:
+        if self._use_native_async:
+            return await model.generate_content_async(
+                prompt,
+                generation_config=self.generation_config,
+                safety_settings=self.safety_settings
+            )
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(
+                model.generate_content,
+                prompt,
+                generation_config=self.generation_config,
+                safety_settings=self.safety_settings
+            )
+        )
+
+    async def stream(self, prompt: str, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """以串流方式逐段產生文字
+
+        逾時套用在「等待下一段」上，長回覆不會因總時長被中斷。呼叫端提前
+        停止迭代時請呼叫 aclose()，以便釋放並行名額。
+        """
+        timeout = self.timeout if timeout is None else timeout
+
+        async with self._semaphore:
+            if self._use_native_async:
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(
+                        prompt,
+                        generation_config=self.generation_config,
+                        safety_settings=self.safety_settings,
+                        stream=True
+                    ),
+                    timeout=timeout
+                )
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        break
+                    text = _chunk_text(chunk)
+                    if text:
+                        yield text
+            else:
+                chunks = self._stream_in_executor(prompt, timeout)
+                try:
+                    async for text in chunks:
+                        yield text
+                finally:
+                    await chunks.aclose()
+
+    async def _stream_in_executor(self, prompt: str, timeout: float) -> AsyncIterator[str]:
+        """在執行緒池中迭代同步串流，透過佇列交回事件循環"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def _put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                pass  # 事件循環已關閉
+
+        def _produce():
+            try:
+                response = self.model.generate_content(
+                    prompt,
+                    generation_config=self.generation_config,
+                    safety_settings=self.safety_settings,
+                    stream=True
+                )
+                for chunk in response:
+                    if stop.is_set():
+                        break
+                    _put(_chunk_text(chunk))
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(done)
+
+        future = loop.run_in_executor(self._executor, _produce)
+        try:
+            while True:
+                item = await asyncio.wait_for(queue.get(), timeout=timeout)
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if item:
+                    yield item
+        finally:
+            stop.set()
+            future.cancel()
+
+    def close(self) -> None:
+        """釋放執行緒池"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _chunk_text(chunk: Any) -> str:
+    """取出串流片段的文字；被安全機制截斷的片段沒有文字，視為空字串"""
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
@@ -0,0 +1,122 @@
+import datetime
+import time
+from enum import IntEnum
+from typing import Dict, FrozenSet, Iterable, Optional
+
+# 備份檔中的時間一律以台灣時間 (UTC+8) 表示
+TAIWAN_TZ = datetime.timezone(datetime.timedelta(hours=8))
+
+
+class Sender(IntEnum):
+    """訊息發送者"""
+    USER = 0
+    BOT = 1
+
+    @property
+    def label(self) -> str:
+        return "user" if self is Sender.USER else "bot"
+
+    @classmethod
+    def parse(cls, value) -> "Sender":
+        if isinstance(value, Sender):
+            return value
+        return cls.USER if value == "user" else cls.BOT
+
+
+# 相同的分類組合共用同一個 frozenset
+_CATEGORY_POOL: Dict[FrozenSet[str], FrozenSet[str]] = {}
+
+
+def intern_categories(categories: Optional[Iterable[str]]) -> Optional[FrozenSet[str]]:
+    if categories is None:
+        return None
+    key = frozenset(categories)
+    return _CATEGORY_POOL.setdefault(key, key)
+
+
+class MessageRecord:
+    """精簡的訊息紀錄
+
+    聊天歷史與記憶系統共用同一個物件；時間以整數 epoch 秒儲存，
+    寫入備份時才轉成 ISO 字串，維持 JSON 檔的可讀性。
+    """
+
+    __slots__ = ("content", "sender", "timestamp", "importance", "categories")
+
+    def __init__(self, content: str, sender, timestamp: Optional[int] = None,
+                 importance: float = 0.0, categories: Optional[Iterable[str]] = None):
+        self.content = content
+        self.sender = Sender.parse(sender)
+        self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.importance = importance
+        self.categories = intern_categories(categories)
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.timestamp, TAIWAN_TZ)
+
+    def to_dict(self) -> dict:
+        """轉成寫入備份用的 dict"""
+        data = {
+            "sender": self.sender.label,
+            "content": self.content,
+            "timestamp": format_timestamp(self.timestamp),
+            "importance": self.importance
+        }
+        if self.categories is not None:
+            data["categories"] = sorted(self.categories)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MessageRecord":
+        """由備份中的 dict 還原，相容舊版欄位"""
+        return cls(
+            data.get("content", ""),
+            data.get("sender", "user"),
+            parse_timestamp(data.get("timestamp")),
+            data.get("importance", 0.0),
+            data.get("categories")
+        )
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.sender.label!r}, {self.content[:20]!r}, {self.timestamp})"
+
+
+UTC_OFFSET_SECONDS = 8 * 3600  # 台灣時間與 UTC 的差距
+_DATE_CACHE: Dict[int, str] = {}
+
+
+def format_timestamp(timestamp: int) -> str:
+    """epoch 秒轉成台灣時間 ISO 字串，與 created_at.isoformat("#", "seconds") 相同
+
+    備份時每則訊息都要轉一次，日期部分依天快取，比經過 datetime 快一倍左右。
+    """
+    day, seconds = divmod(timestamp + UTC_OFFSET_SECONDS, 86400)
+    date = _DATE_CACHE.get(day)
+    if date is None:
+        if len(_DATE_CACHE) > 4096:
+            _DATE_CACHE.clear()
+        date = _DATE_CACHE[day] = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+    hour, rest = divmod(seconds, 3600)
+    minute, second = divmod(rest, 60)
+    return f"{date}#{hour:02d}:{minute:02d}:{second:02d}+08:00"
+
+
+def parse_timestamp(value) -> int:
+    """把備份中的時間（ISO 字串或 epoch 數字）轉成 epoch 秒；無法解析時用現在時間"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            # 沒有時區的舊資料視為本機時間
+            return int(datetime.datetime.fromisoformat(value).timestamp())
+        except ValueError:
+            pass
+    return int(time.time())
+
+
+def to_record(message) -> MessageRecord:
+    """接受 MessageRecord 或舊格式的 dict"""
+    if isinstance(message, MessageRecord):
+        return message
+    return MessageRecord.from_dict(message)
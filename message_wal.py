@@ -0,0 +1,205 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import serialization
+from message_record import MessageRecord
+
+# 群組提交間隔（秒）：這段時間內的追加合併成一次 write + fsync
+WAL_COMMIT_INTERVAL = float(os.getenv("WAL_COMMIT_INTERVAL", "0.005"))
+
+_SEGMENT_PATTERN = re.compile(r"^wal_(\d+)\.log$")
+
+
+def unpersisted_messages(persisted, messages: List[MessageRecord]) -> List[MessageRecord]:
+    """從重播的訊息中去掉已經在 persisted（由舊到新的訊息紀錄）裡的
+
+    以 (時間, 發送者, 內容) 比對；比 persisted 最後一則還早的訊息代表保存後又被裁掉，同樣略過。
+    """
+    persisted = list(persisted)
+    if not persisted:
+        return list(messages)
+
+    keys = {(message.timestamp, message.sender, message.content) for message in persisted}
+    newest = persisted[-1].timestamp
+    return [message for message in messages
+            if message.timestamp >= newest
+            and (message.timestamp, message.sender, message.content) not in keys]
+
+
+class MessageWAL:
+    """訊息預寫日誌（write-ahead log）
+
+    每則新訊息在事件循環上編碼成一行 JSONL 放進緩衝區，背景執行緒每隔
+    commit_interval 把累積的訊息一次寫入並 fsync（群組提交），回覆流程不等磁碟。
+    日誌分段存放：備份開始前 rotate() 換到新的一段，快照寫入成功後
+    discard_before() 刪掉舊段。程序當機時，上次備份之後的訊息可由 replay() 找回。
+    """
+
+    def __init__(self, directory: str, commit_interval: float = WAL_COMMIT_INTERVAL):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._buffer = []           # [(段號, 編碼後的一行)]
+        self._appended = 0          # 已放進緩衝區的行數
+        self._synced = 0            # 已 fsync 的行數
+        self._closed = False
+
+        # 已存在的段留給 replay，新訊息從下一段開始寫
+        segments = self._segments()
+        self._segment = segments[-1] + 1 if segments else 1
+        self._file = None
+        self._file_segment = None
+
+        self._writer = threading.Thread(target=self._writer_loop, name="message-wal", daemon=True)
+        self._writer.start()
+
+    # ----- 追加 -----
+
+    def append(self, user_id: int, record: MessageRecord) -> None:
+        """記下一則新訊息（不等待寫入）"""
+        self._put(serialization.dumps_line({"u": user_id, "m": record}))
+
+    def append_clear(self, user_id: int) -> None:
+        """記下用戶資料已被清除，重播時略過此前的訊息"""
+        self._put(serialization.dumps_line({"u": user_id, "clear": True}))
+
+    def _put(self, line: bytes) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._buffer.append((self._segment, line))
+            self._appended += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待目前為止追加的訊息都已 fsync"""
+        with self._cond:
+            target = self._appended
+            return self._cond.wait_for(lambda: self._synced >= target or self._closed, timeout)
+
+    # ----- 分段 -----
+
+    def rotate(self) -> int:
+        """之後的訊息寫到新的一段；回傳新段號，快照成功後以它呼叫 discard_before()"""
+        with self._cond:
+            self._segment += 1
+            return self._segment
+
+    def discard_before(self, segment: int) -> None:
+        """刪除段號小於 segment 的日誌（其中的訊息都已寫入備份）"""
+        self.flush()
+        removed = 0
+        for number in self._segments():
+            if number >= segment:
+                break
+            try:
+                os.remove(self._segment_path(number))
+                removed += 1
+            except OSError as e:
+                print(f"刪除預寫日誌 wal_{number}.log 失敗: {e}")
+        if removed:
+            print(f"已清除 {removed} 段已備份的預寫日誌")
+
+    def _segments(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"wal_{number:06d}.log")
+
+    # ----- 重播 -----
+
+    def replay(self) -> Dict[int, List[MessageRecord]]:
+        """讀出所有日誌段中的訊息，依用戶分組並維持原本順序
+
+        尾端寫到一半的行直接略過；遇到清除紀錄時丟掉該用戶之前的訊息。
+        """
+        replayed: Dict[int, List[MessageRecord]] = OrderedDict()
+        for number in self._segments():
+            if number >= self._segment:
+                break
+            try:
+                with open(self._segment_path(number), "rb") as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            entry = serialization.loads(line)
+                            user_id = int(entry["u"])
+                        except (serialization.DecodeError, KeyError, TypeError, ValueError):
+                            continue
+                        if entry.get("clear"):
+                            replayed.pop(user_id, None)
+                        elif "m" in entry:
+                            replayed.setdefault(user_id, []).append(MessageRecord.from_dict(entry["m"]))
+            except OSError as e:
+                print(f"讀取預寫日誌 wal_{number}.log 失敗: {e}")
+        return replayed
+
+    # ----- 背景寫入 -----
+
+    def _writer_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._buffer or self._closed)
+                if not self._buffer and self._closed:
+                    break
+
+            # 等一小段時間，讓同時到達的訊息一起提交
+            if not self._closed:
+                time.sleep(self.commit_interval)
+
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                print(f"寫入預寫日誌失敗: {e}")
+
+            with self._cond:
+                self._synced += len(batch)
+                self._cond.notify_all()
+
+        self._close_file()
+
+    def _write_batch(self, batch: list) -> None:
+        start = 0
+        while start < len(batch):
+            segment = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] == segment:
+                end += 1
+
+            if self._file_segment != segment:
+                self._close_file()
+                self._file = open(self._segment_path(segment), "ab")
+                self._file_segment = segment
+
+            self._file.write(b"".join(line for _, line in batch[start:end]))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            start = end
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_segment = None
+
+    def close(self) -> None:
+        """寫完緩衝區後停止背景執行緒"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
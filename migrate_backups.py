@@ -0,0 +1,67 @@
+"""把 JSON 檔案備份（chat_backups/、joy_memory/）匯入 SQLite 後端
+
+用法: python migrate_backups.py [--chat-dir chat_backups] [--memory-dir joy_memory] [--database 路徑]
+
+匯入後設定環境變數 BACKUP_BACKEND=sqlite 即可改用 SQLite。原本的 JSON 檔不會被刪除。
+"""
+import argparse
+import os
+import sys
+
+from chat_backup_manager import MAX_HISTORY_LENGTH
+from storage_backends import JsonStorageBackend, SqliteStorageBackend
+
+
+def migrate(chat_directory: str, memory_directory: str, database_path: str,
+            history_limit: int = MAX_HISTORY_LENGTH) -> tuple:
+    """匯入所有聊天記錄與記憶，回傳 (聊天用戶數, 記憶用戶數)"""
+
+    source = JsonStorageBackend(chat_directory, memory_directory)
+    target = SqliteStorageBackend(database_path)
+
+    try:
+        chats = source.load_chats(history_limit)
+        memory_users = source.memory_users()
+
+        # 全部包在同一個交易裡，中途失敗不會留下一半的資料
+        with target.batch():
+            for user_id, messages in chats.items():
+                target.replace_chat(user_id, messages)
+                print(f" 已匯入用戶 {user_id} 的 {len(messages)} 則聊天記錄")
+
+            for user_id in memory_users:
+                memory_data = source.load_memory(user_id)
+                if memory_data is not None:
+                    target.save_memory(user_id, memory_data, source.memory_digest(user_id))
+                    print(f" 已匯入用戶 {user_id} 的記憶數據")
+
+        return len(chats), len(memory_users)
+
+    finally:
+        target.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="把 JSON 備份匯入 SQLite")
+    parser.add_argument("--chat-dir", default="chat_backups", help="聊天備份目錄")
+    parser.add_argument("--memory-dir", default="joy_memory", help="記憶備份目錄")
+    parser.add_argument("--database", default=None,
+                        help="SQLite 檔案路徑（預設為 BACKUP_DATABASE 或 <聊天備份目錄>/backup.db）")
+    args = parser.parse_args()
+
+    database_path = args.database or os.getenv("BACKUP_DATABASE",
+                                               os.path.join(args.chat_dir, "backup.db"))
+
+    for directory in (args.chat_dir, args.memory_dir):
+        if not os.path.isdir(directory):
+            print(f"找不到目錄 {directory}")
+            return 1
+
+    print(f"正在把 {args.chat_dir}/、{args.memory_dir}/ 匯入 {database_path} ...")
+    chat_users, memory_users = migrate(args.chat_dir, args.memory_dir, database_path)
+    print(f"匯入完成：聊天記錄 {chat_users} 位用戶，記憶 {memory_users} 位用戶")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""列出或還原用戶的時間點快照
+
+用法:
+    python restore_snapshot.py 用戶ID --list
+    python restore_snapshot.py 用戶ID [--at "2025-01-31 21:00"] [--chat-dir chat_backups] [--memory-dir joy_memory]
+
+--at 為台灣時間，還原成該時間當下最近一個快照；省略時還原最新的快照。
+還原會覆寫該用戶目前的聊天備份與記憶，請先停止機器人再執行。
+"""
+import argparse
+import datetime
+import sys
+
+import pytz
+
+from chat_backup_manager import BackupManager
+
+TAIWAN_TZ = pytz.timezone('Asia/Taipei')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="列出或還原用戶的時間點快照")
+    parser.add_argument("user_id", type=int, help="用戶 ID")
+    parser.add_argument("--at", default=None, help="還原到此時間（台灣時間，例如 2025-01-31 21:00）")
+    parser.add_argument("--list", action="store_true", help="只列出可還原的時間點")
+    parser.add_argument("--chat-dir", default="chat_backups", help="聊天備份目錄")
+    parser.add_argument("--memory-dir", default="joy_memory", help="記憶備份目錄")
+    args = parser.parse_args()
+
+    at = None
+    if args.at:
+        try:
+            at = TAIWAN_TZ.localize(datetime.datetime.fromisoformat(args.at))
+        except ValueError:
+            print(f"無法辨識的時間: {args.at}")
+            return 1
+
+    manager = BackupManager(args.chat_dir, args.memory_dir)
+    try:
+        if args.list:
+            points = manager.list_user_snapshots(args.user_id)
+            if not points:
+                print(f"用戶 {args.user_id} 沒有時間點快照")
+            for point in points:
+                print(point.strftime('%Y-%m-%d %H:%M:%S'))
+            return 0
+
+        if manager.restore_user_snapshot(args.user_id, at) is None:
+            print(f"用戶 {args.user_id} 在指定時間之前沒有可用的快照")
+            return 1
+        return 0
+
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
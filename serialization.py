@@ -0,0 +1,130 @@
+import datetime
+import hashlib
+import json
+import os
+from collections import deque
+from typing import Any, Iterable
+
+from message_record import MessageRecord
+
+# 備份用的 JSON 編解碼
+#
+# 依序嘗試 orjson、msgspec，都沒有安裝時使用標準庫 json；可用環境變數
+# BACKUP_SERIALIZER 指定（orjson / msgspec / json）。MessageRecord、deque 等型別
+# 交給 default hook 在編碼時轉換，不必先把整份資料走過一遍。
+# 輸出預設為精簡格式，BACKUP_PRETTY_JSON=1 時記憶檔改為縮排（方便人工查看）。
+
+PRETTY_JSON = os.getenv("BACKUP_PRETTY_JSON", "0") == "1"
+
+# 記憶中每次保存都會變動、不計入內容摘要的欄位（備份與時間點快照共用）
+MEMORY_VOLATILE_FIELDS = ("last_updated",)
+
+
+def _default(obj: Any) -> Any:
+    """編碼器不認得的型別"""
+    if isinstance(obj, MessageRecord):
+        return obj.to_dict()
+    if isinstance(obj, (deque, tuple, set, frozenset)):
+        return list(obj)
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if hasattr(obj, "__iter__") and not isinstance(obj, (str, bytes, dict)):
+        # 例如 ImportantMemoryStore
+        return list(obj)
+    try:
+        return str(obj)
+    except Exception:
+        return f"<不可序列化物件: {type(obj).__name__}>"
+
+
+def _load_orjson():
+    import orjson
+
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any, pretty: bool = False) -> bytes:
+        return orjson.dumps(obj, default=_default,
+                            option=options | orjson.OPT_INDENT_2 if pretty else options)
+
+    def dumps_line(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default, option=options | orjson.OPT_APPEND_NEWLINE)
+
+    return "orjson", dumps, dumps_line, orjson.loads, orjson.JSONDecodeError
+
+
+def _load_msgspec():
+    import msgspec
+
+    encoder = msgspec.json.Encoder(enc_hook=_default)
+
+    def dumps(obj: Any, pretty: bool = False) -> bytes:
+        data = encoder.encode(obj)
+        return msgspec.json.format(data, indent=2) if pretty else data
+
+    def dumps_line(obj: Any) -> bytes:
+        return encoder.encode(obj) + b"\n"
+
+    return "msgspec", dumps, dumps_line, msgspec.json.decode, (msgspec.DecodeError, ValueError)
+
+
+def _load_json():
+    def dumps(obj: Any, pretty: bool = False) -> bytes:
+        if pretty:
+            text = json.dumps(obj, default=_default, ensure_ascii=False, indent=2)
+        else:
+            text = json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":"))
+        return text.encode("utf-8")
+
+    def dumps_line(obj: Any) -> bytes:
+        return dumps(obj) + b"\n"
+
+    return "json", dumps, dumps_line, json.loads, ValueError
+
+
+_LOADERS = {"orjson": _load_orjson, "msgspec": _load_msgspec, "json": _load_json}
+
+
+def _select(preferred: str = "") -> tuple:
+    names = [preferred] if preferred in _LOADERS else []
+    names += [name for name in ("orjson", "msgspec", "json") if name not in names]
+    for name in names:
+        try:
+            return _LOADERS[name]()
+        except ImportError:
+            continue
+    return _load_json()
+
+
+BACKEND, _dumps, _dumps_line, _loads, DecodeError = _select(os.getenv("BACKUP_SERIALIZER", "").lower())
+
+
+def dumps(obj: Any, pretty: bool = False) -> bytes:
+    """編碼成 UTF-8 JSON bytes"""
+    return _dumps(obj, pretty)
+
+
+def dumps_line(obj: Any) -> bytes:
+    """編碼成 JSONL 的一行（含結尾換行）"""
+    return _dumps_line(obj)
+
+
+def dumps_lines(objs: Iterable[Any]) -> bytes:
+    """編碼成 JSONL（每個物件一行，含結尾換行）"""
+    return b"".join(_dumps_line(obj) for obj in objs)
+
+
+def loads(data: Any) -> Any:
+    """解碼 JSON（bytes 或 str）"""
+    return _loads(data)
+
+
+def digest(obj: Any, exclude: Iterable[str] = ()) -> str:
+    """以精簡 JSON 編碼計算內容摘要（sha256 十六進位）
+
+    exclude 為 dict 頂層不計入的欄位（例如每次保存都會變的時間戳），
+    內容相同時不論是記憶體中的物件還是從備份讀回的 dict，摘要都一樣。
+    """
+    if exclude and isinstance(obj, dict):
+        exclude = set(exclude)
+        obj = {key: value for key, value in obj.items() if key not in exclude}
+    return hashlib.sha256(_dumps(obj, False)).hexdigest()
@@ -0,0 +1,352 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+import backup_compression
+import backup_layout
+import serialization
+from message_record import UTC_OFFSET_SECONDS, MessageRecord, to_record
+
+# 保留策略：最近 N 個小時／天／週各留一個快照（每個區間留最新的一個）
+SNAPSHOT_RETENTION = os.getenv("SNAPSHOT_RETENTION", "hourly=24,daily=7,weekly=4")
+# 每串差異最多幾個就重新做一次完整快照，限制還原時要套用的差異數
+SNAPSHOT_FULL_EVERY = int(os.getenv("SNAPSHOT_FULL_EVERY", "24"))
+
+RETENTION_PERIODS = {"hourly": 3600, "daily": 86400, "weekly": 7 * 86400}
+_WEEK_ALIGN_SECONDS = 3 * 86400     # epoch 是星期四，位移後週的邊界落在星期一
+
+
+def parse_retention(spec: str) -> Dict[str, int]:
+    """'hourly=24,daily=7,weekly=4' -> {"hourly": 24, ...}；無法辨識的項目略過"""
+    retention = {}
+    for item in spec.split(","):
+        name, _, count = item.strip().partition("=")
+        if name in RETENTION_PERIODS and count.strip().isdigit():
+            retention[name] = int(count)
+        elif item.strip():
+            print(f"無法辨識的快照保留設定: {item.strip()}")
+    return retention
+
+
+def _message_key(message: MessageRecord) -> list:
+    """辨識訊息用的鍵（時間、發送者、內容摘要），記在索引中"""
+    content_hash = hashlib.sha1(message.content.encode("utf-8")).hexdigest()[:16]
+    return [message.timestamp, message.sender.label, content_hash]
+
+
+def _snapshot_user(name: str) -> Optional[int]:
+    """舊版直接放在快照目錄下的用戶目錄名稱 -> user_id"""
+    return int(name) if name.isdigit() else None
+
+
+class SnapshotStore:
+    """聊天歷史與記憶的時間點快照
+
+    每位用戶一個目錄（放在分片目錄下），index.jsonl 依時間列出快照。聊天部分是「完整快照 + 之後的差異」：
+    差異只存上一個快照之後新增的訊息，儲存量與新資料成正比；記憶內容有變才另存一份。
+    每次記錄後依保留策略（每小時／每天／每週）修剪：不再需要的差異合併進下一個
+    保留的快照，整串都用不到的完整快照直接刪除。restore() 可重建任一保留時間點的狀態。
+    """
+
+    def __init__(self, directory: str, retention: Optional[Dict[str, int]] = None,
+                 full_every: int = SNAPSHOT_FULL_EVERY, compression: Optional[str] = None):
+        self.directory = directory
+        self.retention = parse_retention(SNAPSHOT_RETENTION) if retention is None else retention
+        self.full_every = max(1, full_every)
+        self.compression = backup_compression.resolve(compression)
+        self._lock = threading.Lock()
+        self.bytes_written = 0      # 累計寫入的位元組數（壓縮前），供寫入限速估算
+        backup_layout.migrate_flat_layout(directory, _snapshot_user)
+
+    # ----- 路徑與索引 -----
+
+    def _user_dir(self, user_id: int) -> str:
+        return backup_layout.user_path(self.directory, user_id, str(user_id))
+
+    def _path(self, user_id: int, filename: str) -> str:
+        return os.path.join(self._user_dir(user_id), filename)
+
+    def list_snapshots(self, user_id: int) -> List[dict]:
+        """依時間由舊到新列出用戶可還原的快照"""
+        return [entry for entry in self._read_index(user_id) if not entry.get("base")]
+
+    def _read_index(self, user_id: int) -> List[dict]:
+        index_path = self._path(user_id, "index.jsonl")
+        entries = []
+        try:
+            with open(index_path, "rb") as f:
+                for line in f:
+                    try:
+                        entries.append(serialization.loads(line))
+                    except serialization.DecodeError:
+                        continue  # 寫到一半的行
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _write_index(self, user_id: int, entries: List[dict]) -> None:
+        index_path = self._path(user_id, "index.jsonl")
+        tmp_path = index_path + ".tmp"
+        data = serialization.dumps_lines(entries)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        self.bytes_written += len(data)
+        os.replace(tmp_path, index_path)
+
+    def _write_messages(self, user_id: int, filename: str, messages: list) -> str:
+        filename += backup_compression.suffix(self.compression)
+        path = self._path(user_id, filename)
+        data = serialization.dumps_lines(messages)
+        with backup_compression.open_write(path + ".tmp", self.compression) as f:
+            f.write(data)
+        self.bytes_written += len(data)
+        os.replace(path + ".tmp", path)
+        return filename
+
+    def _read_messages(self, user_id: int, filename: str) -> List[dict]:
+        with backup_compression.open_read(self._path(user_id, filename)) as f:
+            return [serialization.loads(line) for line in f if line.strip()]
+
+    def _remove(self, user_id: int, filename: str) -> None:
+        try:
+            os.remove(self._path(user_id, filename))
+        except FileNotFoundError:
+            pass
+
+    # ----- 記錄 -----
+
+    def record(self, user_id: int, history: Optional[list], memory_data: Optional[dict],
+               now: Optional[float] = None) -> Optional[dict]:
+        """記錄一個快照；聊天與記憶都沒有變化時不記錄，回傳新增的索引項目"""
+
+        now = time.time() if now is None else now
+        stamp = int(now * 1000)
+
+        with self._lock:
+            os.makedirs(self._user_dir(user_id), exist_ok=True)
+            entries = self._read_index(user_id)
+            entry = {"time": now}
+
+            if history:
+                records = [to_record(message) for message in history]
+                new_messages, chain_length = self._new_messages(entries, records)
+                if new_messages is None or chain_length >= self.full_every:
+                    entry.update(chat="full", count=len(records),
+                                 file=self._write_messages(user_id, f"full_{stamp}.jsonl", records))
+                elif new_messages:
+                    entry.update(chat="delta", count=len(new_messages),
+                                 file=self._write_messages(user_id, f"delta_{stamp}.jsonl", new_messages))
+                if "chat" in entry:
+                    entry["last"] = _message_key(records[-1])
+
+            if memory_data is not None:
+                digest = serialization.digest(memory_data, serialization.MEMORY_VOLATILE_FIELDS)
+                if digest != self._latest_memory_digest(entries):
+                    filename = f"memory_{stamp}.json{backup_compression.suffix(self.compression)}"
+                    path = self._path(user_id, filename)
+                    data = serialization.dumps(memory_data)
+                    with backup_compression.open_write(path + ".tmp", self.compression) as f:
+                        f.write(data)
+                    self.bytes_written += len(data)
+                    os.replace(path + ".tmp", path)
+                    entry.update(memory=filename, memory_digest=digest)
+
+            if len(entry) == 1:
+                return None
+
+            entries.append(entry)
+            self._write_index(user_id, self._prune(user_id, entries))
+            return entry
+
+    @staticmethod
+    def _new_messages(entries: List[dict], records: List[MessageRecord]) -> tuple:
+        """找出上一個聊天快照之後的新訊息；對不上時回傳 None（需要完整快照）"""
+
+        chain_length = 0
+        last_key = None
+        for entry in reversed(entries):
+            if "chat" not in entry:
+                continue
+            if last_key is None:
+                last_key = entry["last"]
+            if entry["chat"] == "full":
+                break
+            chain_length += 1
+
+        if last_key is None:
+            return None, chain_length
+
+        for index in range(len(records) - 1, -1, -1):
+            if _message_key(records[index]) == last_key:
+                return records[index + 1:], chain_length
+        return None, chain_length
+
+    @staticmethod
+    def _latest_memory_digest(entries: List[dict]) -> Optional[str]:
+        for entry in reversed(entries):
+            if "memory" in entry:
+                return entry.get("memory_digest")
+        return None
+
+    # ----- 保留策略 -----
+
+    def _retained(self, entries: List[dict]) -> set:
+        """依保留策略選出要保留的快照（索引位置）；最新的一個一律保留"""
+
+        keep = {len(entries) - 1}
+        for name, count in self.retention.items():
+            seconds = RETENTION_PERIODS[name]
+            # 依台灣時間切分日／週
+            offset = UTC_OFFSET_SECONDS + (_WEEK_ALIGN_SECONDS if name == "weekly" else 0)
+            buckets = set()
+            for index in range(len(entries) - 1, -1, -1):
+                if entries[index].get("base"):
+                    continue  # 只作為差異基礎的完整快照不是還原點
+                bucket = int(entries[index]["time"] + offset) // seconds
+                if bucket in buckets:
+                    continue
+                if len(buckets) >= count:
+                    break
+                buckets.add(bucket)
+                keep.add(index)
+        return keep
+
+    def _prune(self, user_id: int, entries: List[dict]) -> List[dict]:
+        """刪除保留策略之外的快照
+
+        被刪除的差異合併到同一串中下一個保留的快照，被刪除的記憶移給下一個
+        沒有自己記憶的保留快照；之後沒有任何保留點的整串完整快照與差異直接刪除。
+        """
+        keep = self._retained(entries)
+        if len(keep) == len(entries):
+            return entries
+
+        # 哪些串（以完整快照的位置表示）之後還有保留點
+        needed_chains = set()
+        chain = None
+        for index, entry in enumerate(entries):
+            if entry.get("chat") == "full":
+                chain = index
+            if index in keep and chain is not None:
+                needed_chains.add(chain)
+
+        result = []
+        pending_deltas = []     # 等著合併進下一個保留點的差異檔
+        pending_last = None
+        pending_memory = None   # 等著移給下一個保留點的記憶
+        chain = None
+
+        for index, original in enumerate(entries):
+            entry = dict(original)
+            kept = index in keep
+            kind = entry.get("chat")
+
+            if kind == "full":
+                # 新的一串開始，上一串還沒合併的差異已經用不到
+                for filename in pending_deltas:
+                    self._remove(user_id, filename)
+                pending_deltas, pending_last = [], None
+                chain = index
+                if chain not in needed_chains:
+                    self._remove(user_id, entry["file"])
+                    self._strip_chat(entry)
+            elif kind == "delta":
+                if chain not in needed_chains:
+                    self._remove(user_id, entry["file"])
+                    self._strip_chat(entry)
+                elif not kept:
+                    pending_deltas.append(entry["file"])
+                    pending_last = entry["last"]
+                    self._strip_chat(entry)
+                elif pending_deltas:
+                    entry["file"], entry["count"] = self._merge_deltas(
+                        user_id, pending_deltas + [entry["file"]], entry["time"])
+                    pending_deltas, pending_last = [], None
+
+            if kept and pending_deltas and "chat" not in entry:
+                # 保留點本身只有記憶，把中間的差異掛到它身上
+                entry["file"], entry["count"] = self._merge_deltas(user_id, pending_deltas, entry["time"])
+                entry["chat"], entry["last"] = "delta", pending_last
+                pending_deltas, pending_last = [], None
+
+            if "memory" in entry:
+                if pending_memory:
+                    self._remove(user_id, pending_memory[0])
+                    pending_memory = None
+                if not kept:
+                    pending_memory = (entry.pop("memory"), entry.pop("memory_digest", None))
+            elif kept and pending_memory:
+                entry["memory"], entry["memory_digest"] = pending_memory
+                pending_memory = None
+
+            # 不在保留策略內、但仍是後面差異基礎的完整快照也要留著，標記為非還原點
+            if kept or "chat" in entry:
+                if not kept:
+                    entry["base"] = True
+                result.append(entry)
+
+        return result
+
+    @staticmethod
+    def _strip_chat(entry: dict) -> None:
+        for key in ("chat", "file", "count", "last"):
+            entry.pop(key, None)
+
+    def _merge_deltas(self, user_id: int, filenames: List[str], at: float) -> tuple:
+        """把幾個差異檔合併成一個（時間取保留點的時間），回傳 (檔名, 訊息數)"""
+        messages = []
+        for filename in filenames:
+            messages.extend(self._read_messages(user_id, filename))
+        merged = self._write_messages(user_id, f"delta_{int(at * 1000)}.jsonl", messages)
+        for filename in filenames:
+            if filename != merged:
+                self._remove(user_id, filename)
+        return merged, len(messages)
+
+    # ----- 還原 -----
+
+    def restore(self, user_id: int, at: Optional[float] = None,
+                limit: Optional[int] = None) -> Optional[dict]:
+        """重建用戶在 at（epoch 秒，預設為最新）當下最近一個快照的狀態
+
+        回傳 {"time": 快照時間, "messages": [訊息 dict], "memory": 記憶 dict 或 None}；
+        at 之前沒有任何快照時回傳 None。
+        """
+        with self._lock:
+            entries = [entry for entry in self._read_index(user_id)
+                       if at is None or round(entry["time"] * 1000) <= round(at * 1000)]
+            while entries and entries[-1].get("base"):
+                entries.pop()
+            if not entries:
+                return None
+
+            chain = []
+            for entry in reversed(entries):
+                if "chat" not in entry:
+                    continue
+                chain.append(entry)
+                if entry["chat"] == "full":
+                    break
+            messages = []
+            if chain and chain[-1]["chat"] == "full":
+                for entry in reversed(chain):
+                    messages.extend(self._read_messages(user_id, entry["file"]))
+
+            memory = None
+            for entry in reversed(entries):
+                if "memory" in entry:
+                    with backup_compression.open_read(self._path(user_id, entry["memory"])) as f:
+                        memory = serialization.loads(f.read())
+                    break
+
+        if limit is not None:
+            messages = messages[-limit:]
+        return {"time": entries[-1]["time"], "messages": messages, "memory": memory}
+
+    def delete_user(self, user_id: int) -> None:
+        """刪除用戶的所有快照（用戶要求清除資料時）"""
+        with self._lock:
+            shutil.rmtree(self._user_dir(user_id), ignore_errors=True)
@@ -0,0 +1,806 @@
+import datetime
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import pytz
+
+import backup_compression
+import backup_layout
+import serialization
+from backup_manifest import BackupManifest
+from message_record import MessageRecord, parse_timestamp
+
+TAIWAN_TZ = pytz.timezone('Asia/Taipei')
+
+# 聊天日誌超過此大小（位元組）且含有已裁剪的舊訊息時才整檔壓實
+CHAT_LOG_COMPACT_BYTES = int(os.getenv("CHAT_LOG_COMPACT_BYTES", str(512 * 1024)))
+
+BACKUP_MANIFEST_FILENAME = "backup_manifest.jsonl"
+
+
+class StorageBackend:
+    """備份存儲介面
+
+    BackupManager 只透過這些方法讀寫資料；訊息可以是 MessageRecord 或 dict，
+    由後端以 serialization 編碼，讀回時一律是 dict。時間以 epoch 秒回傳。
+    """
+
+    name = ""
+
+    # 累計寫入的（未壓縮）位元組數，背景備份依此控制寫入速度
+    bytes_written = 0
+
+    # batch() 是否真的合併成一次交易（SQLite）；JSON 後端每次寫入各自完成
+    transactional = False
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """把多次寫入合併成一次交易（不支援交易的後端直接執行）"""
+        yield
+
+    # ----- 聊天記錄 -----
+
+    def load_chats(self, limit: int) -> Dict[int, List[dict]]:
+        """載入所有用戶的聊天記錄，每位最多 limit 則"""
+        raise NotImplementedError
+
+    def load_chat(self, user_id: int, limit: int) -> Optional[List[dict]]:
+        raise NotImplementedError
+
+    def chat_users(self) -> List[int]:
+        """列出有聊天備份的用戶（只讀索引，不讀聊天內容）"""
+        raise NotImplementedError
+
+    def append_chat(self, user_id: int, messages: list) -> bool:
+        """追加新訊息；無法追加（需要整份重寫）時回傳 False"""
+        raise NotImplementedError
+
+    def replace_chat(self, user_id: int, messages: list) -> None:
+        raise NotImplementedError
+
+    def needs_compaction(self, user_id: int, keep: int) -> bool:
+        """存儲中累積的舊訊息是否多到該以目前的 keep 則重寫"""
+        return False
+
+    def delete_chat(self, user_id: int) -> None:
+        raise NotImplementedError
+
+    def latest_chat_time(self, user_id: int) -> Optional[float]:
+        raise NotImplementedError
+
+    def recent_chat_users(self, limit: int) -> List[int]:
+        raise NotImplementedError
+
+    # ----- 記憶 -----
+
+    def save_memory(self, user_id: int, memory_data: dict, digest: Optional[str] = None) -> None:
+        """保存用戶記憶；digest 為內容摘要，與資料一起記下供之後比對"""
+        raise NotImplementedError
+
+    def memory_digest(self, user_id: int) -> Optional[str]:
+        """上次保存的記憶內容摘要；未知時回傳 None"""
+        return None
+
+    def load_memory(self, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def delete_memory(self, user_id: int) -> bool:
+        """刪除用戶記憶；原本就沒有時回傳 False"""
+        raise NotImplementedError
+
+    # ----- 其他 -----
+
+    def stats(self) -> Dict[str, Any]:
+        """回傳 chat_backup_count / memory_backup_count / memory_count / total_users / latest_backup"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class JsonStorageBackend(StorageBackend):
+    """以 JSON 檔案存放備份
+
+    每位用戶一個只追加的 JSONL 檔 (chat_log_{user_id}.jsonl)，一行一則訊息；
+    記憶為 memory_{user_id}.json。舊版的 chat_backup_{user_id}_{時間}.json
+    仍可讀取，第一次重寫時轉為新格式。哪些用戶有哪些檔案記錄在
+    BackupManifest 中，查詢與統計不需要掃描目錄。
+
+    檔案依 user_id 的雜湊放在兩層分片目錄下（見 backup_layout），用戶再多
+    單一目錄也只有少量檔案；舊版直接放在目錄下的檔案在啟動時搬進分片目錄。
+
+    可選擇以 gzip / zstd 壓縮（檔名加上 .gz / .zst）。讀取時依檔頭判斷格式，
+    切換壓縮設定後舊檔仍可讀取，下次整檔寫入時換成新格式。
+    """
+
+    name = "json"
+
+    def __init__(self, backup_directory: str, memory_directory: str,
+                 compression: Optional[str] = None):
+        self.backup_directory = backup_directory
+        self.memory_directory = memory_directory
+        self.compression = backup_compression.resolve(compression)
+
+        os.makedirs(self.backup_directory, exist_ok=True)
+        os.makedirs(self.memory_directory, exist_ok=True)
+        backup_layout.migrate_flat_layout(os.path.abspath(self.backup_directory), _chat_file_user)
+        backup_layout.migrate_flat_layout(os.path.abspath(self.memory_directory), _memory_user)
+
+        # 聊天日誌狀態：user_id -> [行數, 檔案大小]
+        self._log_sizes = {}
+        self._corrupted_logs = set()      # 有損壞行、不能直接追加的用戶
+
+        self.manifest = BackupManifest(
+            os.path.join(os.path.abspath(self.backup_directory), BACKUP_MANIFEST_FILENAME),
+            self._scan_disk
+        )
+
+    def _chat_log_name(self, user_id: int) -> str:
+        return f"chat_log_{user_id}.jsonl{backup_compression.suffix(self.compression)}"
+
+    def _chat_path(self, user_id: int, filename: str) -> str:
+        return backup_layout.user_path(os.path.abspath(self.backup_directory), user_id, filename)
+
+    def _memory_path(self, user_id: int, method: Optional[str] = None) -> str:
+        suffix = backup_compression.suffix(method or self.compression)
+        return backup_layout.user_path(os.path.abspath(self.memory_directory), user_id,
+                                       f"memory_{user_id}.json{suffix}")
+
+    def _memory_variants(self, user_id: int) -> List[str]:
+        """目前設定的檔名優先，其餘壓縮方式的舊檔在後"""
+        methods = [self.compression] + [m for m in backup_compression.SUFFIXES if m != self.compression]
+        return [self._memory_path(user_id, method) for method in methods]
+
+    # ----- 索引 -----
+
+    def _scan_disk(self) -> tuple:
+        """掃描備份目錄，回傳 (聊天索引, 記憶索引) 供 BackupManifest 重建"""
+
+        chats = {}    # user_id -> {"time", "file", "legacy"}
+        abs_path = os.path.abspath(self.backup_directory)
+
+        for entry in backup_layout.iter_user_entries(abs_path):
+            self._add_chat_file(chats, entry)
+
+        memories = {}
+        abs_memory_path = os.path.abspath(self.memory_directory)
+        for entry in backup_layout.iter_user_entries(abs_memory_path):
+            user_id = _memory_user(entry.name)
+            if user_id is not None:
+                try:
+                    memories[user_id] = max(memories.get(user_id, 0), entry.stat().st_mtime)
+                except OSError:
+                    continue
+
+        return chats, memories
+
+    def _add_chat_file(self, chats: dict, entry: os.DirEntry) -> None:
+        """把一個聊天備份檔記入 chats（user_id -> {"time", "file", "legacy"}）；不是聊天備份時略過"""
+
+        name = entry.name
+        try:
+            log_user = _chat_log_user(name)
+            if log_user is not None:
+                chat = chats.setdefault(log_user, {"time": 0, "file": None, "legacy": []})
+                mtime = entry.stat().st_mtime
+                if _chat_log_user(chat["file"] or "") is None or mtime >= chat["time"]:
+                    # 同一用戶有多種壓縮格式的日誌時，較舊的當作待刪除的舊檔
+                    if chat["file"] and _chat_log_user(chat["file"]) is not None:
+                        chat["legacy"].append(chat["file"])
+                    chat["file"] = name
+                else:
+                    chat["legacy"].append(name)
+                chat["time"] = max(chat["time"], mtime)
+
+            elif name.startswith('chat_backup_') and name.endswith('.json'):
+                parsed = self._parse_chat_backup_filename(name)
+                if not parsed:
+                    return
+                user_id, timestamp = parsed
+                timestamp = TAIWAN_TZ.localize(timestamp).timestamp()
+                chat = chats.setdefault(user_id, {"time": 0, "file": None, "legacy": []})
+                chat["legacy"].append(name)
+                # 沒有日誌時以最新的舊版備份為準
+                if _chat_log_user(chat["file"] or "") is None and timestamp >= chat["time"]:
+                    chat["file"] = name
+                chat["time"] = max(chat["time"], timestamp)
+
+        except (ValueError, OSError) as e:
+            print(f"解析檔案 {name} 時發生錯誤: {e}")
+            return
+
+    def _recover_chat_entry(self, user_id: int) -> Optional[dict]:
+        """只掃描該用戶的分片目錄，依磁碟上的檔案更新索引，回傳索引項目（沒有檔案時為 None）
+
+        索引沒有該用戶，或指向已被刪除的檔案時使用（寫入備份後、更新索引前當機），
+        啟動時不必為此走訪所有分片目錄。
+        """
+        chats = {}
+        try:
+            with os.scandir(os.path.dirname(self._chat_path(user_id, ""))) as entries:
+                for entry in entries:
+                    self._add_chat_file(chats, entry)
+        except FileNotFoundError:
+            pass
+
+        found = chats.get(user_id)
+        indexed = self.manifest.chats.get(user_id)
+        if found is None or not found["file"]:
+            if indexed is not None:
+                self.manifest.remove_chat(user_id)
+            return None
+
+        if indexed is None or indexed["file"] != found["file"] or \
+                sorted(indexed["legacy"]) != sorted(found["legacy"]):
+            print(f"用戶 {user_id} 的備份索引與磁碟不符，已依分片目錄更新")
+            self.manifest.set_chat(user_id, found["time"], found["file"], found["legacy"])
+        return self.manifest.chats.get(user_id)
+
+    def _reconcile_manifest(self) -> None:
+        """比對一次檔名；索引與磁碟不一致（例如寫入後、更新索引前當機）時重建
+
+        只在索引開啟時被重建過或尾端有寫到一半的紀錄時執行，其餘情況直接採信索引，
+        啟動時不必走訪所有分片目錄。
+        """
+        if not self.manifest.needs_reconcile:
+            return
+        self.manifest.needs_reconcile = False
+
+        abs_path = os.path.abspath(self.backup_directory)
+        on_disk = set()
+        for entry in backup_layout.iter_user_entries(abs_path):
+            name = entry.name
+            if _chat_log_user(name) is not None or \
+                    (name.startswith('chat_backup_') and name.endswith('.json')):
+                on_disk.add(name)
+
+        indexed = set()
+        for entry in self.manifest.chats.values():
+            indexed.update(entry["legacy"])
+            if entry["file"]:
+                indexed.add(entry["file"])
+
+        if on_disk != indexed:
+            print("備份索引與磁碟不一致，重新建立")
+            self.manifest.rebuild()
+
+    # ----- 聊天記錄 -----
+
+    def load_chats(self, limit: int) -> Dict[int, List[dict]]:
+        loaded_history = {}
+        for user_id in self.chat_users():
+            try:
+                messages = self.load_chat(user_id, limit)
+            except Exception as e:
+                print(f" 載入用戶 {user_id} 聊天紀錄時發生錯誤: {e}")
+                continue
+            if messages is not None:
+                loaded_history[user_id] = messages
+
+        return loaded_history
+
+    def chat_users(self) -> List[int]:
+        abs_path = os.path.abspath(self.backup_directory)
+        if not os.path.exists(abs_path):
+            print(f"備份目錄 {abs_path} 不存在")
+            return []
+
+        self._reconcile_manifest()
+        return list(self.manifest.chats)
+
+    def load_chat(self, user_id: int, limit: int) -> Optional[List[dict]]:
+        """讀取用戶聊天紀錄並記下日誌狀態，之後的備份可直接追加"""
+
+        self.manifest.refresh()
+        entry = self.manifest.chats.get(user_id)
+        if entry is None or _chat_log_user(entry["file"] or "") is None:
+            # 索引中沒有日誌（新用戶、只有舊版備份，或寫入日誌後、更新索引前當機），看一下分片目錄
+            entry = self._recover_chat_entry(user_id)
+        if entry is None:
+            return None
+
+        try:
+            return self._read_chat_entry(user_id, entry["file"], limit)
+        except FileNotFoundError:
+            # 索引指向已被取代的檔案
+            entry = self._recover_chat_entry(user_id)
+            return self._read_chat_entry(user_id, entry["file"], limit) if entry else None
+
+    def _read_chat_entry(self, user_id: int, filename: str, limit: int) -> List[dict]:
+        if _chat_log_user(filename) is not None:
+            messages, lines, size, corrupted = self._read_chat_log(self._chat_path(user_id, filename), limit)
+            self._log_sizes[user_id] = [lines, size]
+            if corrupted:
+                # 不能接在損壞的行後面追加，下次保存時整檔重寫
+                self._corrupted_logs.add(user_id)
+            return messages
+
+        # 只有舊版備份，第一次保存時重寫成日誌
+        messages, _ = self._read_chat_backup(self._chat_path(user_id, filename))
+        return messages[-limit:]
+
+    def append_chat(self, user_id: int, messages: list) -> bool:
+        if user_id in self._corrupted_logs or user_id not in self._log_sizes:
+            return False
+
+        filename = self._chat_log_name(user_id)
+        entry = self.manifest.chats.get(user_id)
+        if entry is None or entry["file"] != filename:
+            return False  # 壓縮設定改變，整檔重寫成新格式
+
+        log_path = self._chat_path(user_id, filename)
+        with backup_compression.open_write(log_path, self.compression, append=True) as f:
+            for message in messages:
+                line = serialization.dumps_line(message)
+                f.write(line)
+                self.bytes_written += len(line)
+
+        sizes = self._log_sizes[user_id]
+        sizes[0] += len(messages)
+        sizes[1] = os.path.getsize(log_path)
+
+        self.manifest.set_chat(user_id, time.time(), filename, entry["legacy"])
+        return True
+
+    def replace_chat(self, user_id: int, messages: list) -> None:
+        """整檔重寫日誌（先寫暫存檔再取代，中途失敗不會留下半個檔案）"""
+
+        filename = self._chat_log_name(user_id)
+        log_path = self._chat_path(user_id, filename)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        tmp_path = log_path + ".tmp"
+        with backup_compression.open_write(tmp_path, self.compression) as f:
+            for message in messages:
+                line = serialization.dumps_line(message)
+                f.write(line)
+                self.bytes_written += len(line)
+        os.replace(tmp_path, log_path)
+
+        self._log_sizes[user_id] = [len(messages), os.path.getsize(log_path)]
+        self._corrupted_logs.discard(user_id)
+
+        # 先更新索引再刪除被取代的舊版備份與其他壓縮格式的舊日誌，
+        # 中途當機時索引不會指向已刪除的檔案
+        entry = self.manifest.chats.get(user_id)
+        self.manifest.set_chat(user_id, time.time(), filename)
+        if entry:
+            stale = [name for name in entry["legacy"] + [entry["file"]] if name and name != filename]
+            if stale:
+                self._delete_chat_files(user_id, stale, "舊聊天備份")
+
+    def needs_compaction(self, user_id: int, keep: int) -> bool:
+        sizes = self._log_sizes.get(user_id)
+        return bool(sizes) and sizes[1] > CHAT_LOG_COMPACT_BYTES and sizes[0] > keep
+
+    def delete_chat(self, user_id: int) -> None:
+        self._log_sizes.pop(user_id, None)
+        self._corrupted_logs.discard(user_id)
+
+        entry = self.manifest.chats.get(user_id)
+        if entry is None:
+            return
+
+        filenames = list(entry["legacy"])
+        if entry["file"] and entry["file"] not in filenames:
+            filenames.append(entry["file"])
+        self._delete_chat_files(user_id, filenames, "聊天備份")
+        self.manifest.remove_chat(user_id)
+
+    def _delete_chat_files(self, user_id: int, filenames: List[str], label: str) -> None:
+        for filename in filenames:
+            try:
+                os.remove(self._chat_path(user_id, filename))
+                print(f"  - 已刪除{label}: {filename}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"  - 無法刪除{label} {filename}: {e}")
+
+    def latest_chat_time(self, user_id: int) -> Optional[float]:
+        self.manifest.refresh()
+        return self.manifest.chat_time(user_id)
+
+    def recent_chat_users(self, limit: int) -> List[int]:
+        self.manifest.refresh()
+        chats = self.manifest.chats
+        return heapq.nlargest(limit, list(chats), key=lambda user_id: chats[user_id]["time"])
+
+    def _read_chat_log(self, filepath: str, limit: int) -> tuple:
+        """讀取 JSONL 日誌，只保留最後 limit 則；回傳 (訊息, 行數, 位元組數, 是否有損壞行)"""
+
+        messages = deque(maxlen=limit)
+        lines = 0
+        corrupted = False
+        with backup_compression.open_read(filepath) as f:
+            try:
+                for raw_line in f:
+                    lines += 1
+                    try:
+                        messages.append(serialization.loads(raw_line))
+                    except serialization.DecodeError:
+                        # 寫到一半中斷的最後一行
+                        print(f" 略過 {os.path.basename(filepath)} 第 {lines} 行的損壞資料")
+                        corrupted = True
+            except backup_compression.TruncatedError as e:
+                # 壓縮檔尾端不完整，保留已讀到的部分
+                print(f" {os.path.basename(filepath)} 尾端不完整: {e}")
+                corrupted = True
+        return list(messages), lines, os.path.getsize(filepath), corrupted
+
+    @staticmethod
+    def _parse_chat_backup_filename(filename: str) -> Optional[tuple]:
+        """從舊版備份檔名解析 (user_id, 備份時間)"""
+
+        parts = filename.split('_')
+        if len(parts) < 6:
+            return None
+        user_id = int(parts[2])
+        timestamp_str = f"{parts[3]}_{parts[4]}_{parts[5].split('.')[0]}"
+        timestamp = datetime.datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S_%f")
+        return user_id, timestamp
+
+    @staticmethod
+    def _read_chat_backup(filepath: str) -> tuple:
+        """讀取舊版聊天備份檔，回傳 (訊息列表, 訊息數)"""
+
+        with open(filepath, 'rb') as f:
+            backup_data = serialization.loads(f.read())
+
+        # 兼容舊格式和新格式
+        if isinstance(backup_data, list):
+            # 舊格式：直接是訊息列表
+            return backup_data, len(backup_data)
+
+        # 新格式：包含metadata的物件
+        messages = backup_data.get("messages", [])
+        return messages, backup_data.get("message_count", len(messages))
+
+    # ----- 記憶 -----
+
+    def save_memory(self, user_id: int, memory_data: dict, digest: Optional[str] = None) -> None:
+        memory_file, *stale_files = self._memory_variants(user_id)
+        os.makedirs(os.path.dirname(memory_file), exist_ok=True)
+        tmp_path = memory_file + ".tmp"
+        data = serialization.dumps(memory_data, pretty=serialization.PRETTY_JSON)
+        with backup_compression.open_write(tmp_path, self.compression) as f:
+            f.write(data)
+        self.bytes_written += len(data)
+        os.replace(tmp_path, memory_file)
+
+        # 切換壓縮設定前留下的舊檔
+        for stale_file in stale_files:
+            try:
+                os.remove(stale_file)
+            except FileNotFoundError:
+                pass
+
+        self.manifest.set_memory(user_id, time.time(), digest)
+
+    def memory_digest(self, user_id: int) -> Optional[str]:
+        self.manifest.refresh()
+        return self.manifest.memory_digests.get(user_id)
+
+    def load_memory(self, user_id: int) -> Optional[dict]:
+        for memory_file in self._memory_variants(user_id):
+            try:
+                with backup_compression.open_read(memory_file) as f:
+                    return serialization.loads(f.read())
+            except FileNotFoundError:
+                continue
+        return None
+
+    def delete_memory(self, user_id: int) -> bool:
+        deleted = False
+        for memory_file in self._memory_variants(user_id):
+            try:
+                os.remove(memory_file)
+            except FileNotFoundError:
+                continue
+            print(f"  - 已刪除舊記憶{os.path.basename(memory_file)}")
+            deleted = True
+
+        self.manifest.remove_memory(user_id)
+        return deleted
+
+    def memory_users(self) -> List[int]:
+        """列出有記憶備份的用戶（搬移工具用）"""
+        return list(self.manifest.memories)
+
+    # ----- 其他 -----
+
+    def stats(self) -> Dict[str, Any]:
+        manifest = self.manifest
+        manifest.refresh()
+        return {
+            "chat_backup_count": len(manifest.chats),
+            "memory_backup_count": len(manifest.memories),
+            "total_users": manifest.total_users,
+            "memory_count": len(manifest.memories),
+            "latest_backup": manifest.latest_time
+        }
+
+
+class SqliteStorageBackend(StorageBackend):
+    """以 SQLite 存放備份
+
+    使用 WAL 模式，讀取不會被寫入阻塞；每個執行緒各自一條連線。
+    聊天訊息以 (user_id, id) 與 (user_id, timestamp) 建索引，
+    chat_users / memories 兩張小表讓統計與最新備份時間都是索引查詢。
+    """
+
+    name = "sqlite"
+    transactional = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_user_id ON chat_messages (user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_chat_messages_timestamp ON chat_messages (user_id, timestamp);
+
+        CREATE TABLE IF NOT EXISTS chat_users (
+            user_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL,
+            backup_time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_users_backup_time ON chat_users (backup_time);
+
+        CREATE TABLE IF NOT EXISTS memories (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            backup_time REAL NOT NULL,
+            digest TEXT
+        );
+    """
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        directory = os.path.dirname(os.path.abspath(database_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        # executescript 會自行提交，不放在 _transaction 裡
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+
+        # 舊版資料庫的 memories 沒有 digest 欄位
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(memories)")}
+        if "digest" not in columns:
+            conn.execute("ALTER TABLE memories ADD COLUMN digest TEXT")
+            conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：交易由 _transaction 明確控制
+            conn = sqlite3.connect(self.database_path, isolation_level=None,
+                                   check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """寫入交易；在 batch() 之內時併入外層交易"""
+        conn = self._connection()
+        if self._local.depth:
+            yield conn
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self._transaction():
+            yield
+
+    # ----- 聊天記錄 -----
+
+    def load_chats(self, limit: int) -> Dict[int, List[dict]]:
+        conn = self._connection()
+        return {user_id: self._select_chat(conn, user_id, limit) for user_id in self.chat_users()}
+
+    def chat_users(self) -> List[int]:
+        return [row[0] for row in self._connection().execute("SELECT user_id FROM chat_users")]
+
+    def load_chat(self, user_id: int, limit: int) -> Optional[List[dict]]:
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM chat_users WHERE user_id = ?", (user_id,)).fetchone() is None:
+            return None
+        return self._select_chat(conn, user_id, limit)
+
+    @staticmethod
+    def _select_chat(conn: sqlite3.Connection, user_id: int, limit: int) -> List[dict]:
+        rows = conn.execute(
+            "SELECT data FROM chat_messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return [serialization.loads(row[0]) for row in rows]
+
+    def append_chat(self, user_id: int, messages: list) -> bool:
+        with self._transaction() as conn:
+            self._insert_messages(conn, user_id, messages)
+            conn.execute(
+                "INSERT INTO chat_users (user_id, message_count, backup_time) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "message_count = message_count + excluded.message_count, backup_time = excluded.backup_time",
+                (user_id, len(messages), time.time())
+            )
+        return True
+
+    def replace_chat(self, user_id: int, messages: list) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chat_messages WHERE user_id = ?", (user_id,))
+            self._insert_messages(conn, user_id, messages)
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_users (user_id, message_count, backup_time) VALUES (?, ?, ?)",
+                (user_id, len(messages), time.time())
+            )
+
+    def _insert_messages(self, conn: sqlite3.Connection, user_id: int, messages: list) -> None:
+        rows = [(user_id, _message_timestamp(message), serialization.dumps(message).decode("utf-8"))
+                for message in messages]
+        conn.executemany("INSERT INTO chat_messages (user_id, timestamp, data) VALUES (?, ?, ?)", rows)
+        self.bytes_written += sum(len(row[2]) for row in rows)
+
+    def needs_compaction(self, user_id: int, keep: int) -> bool:
+        row = self._connection().execute(
+            "SELECT message_count FROM chat_users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        # 保留一倍的餘裕，避免每次追加都觸發刪除
+        return bool(row) and row[0] > keep * 2
+
+    def delete_chat(self, user_id: int) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM chat_messages WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM chat_users WHERE user_id = ?", (user_id,))
+
+    def latest_chat_time(self, user_id: int) -> Optional[float]:
+        row = self._connection().execute(
+            "SELECT backup_time FROM chat_users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def recent_chat_users(self, limit: int) -> List[int]:
+        rows = self._connection().execute(
+            "SELECT user_id FROM chat_users ORDER BY backup_time DESC LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    # ----- 記憶 -----
+
+    def save_memory(self, user_id: int, memory_data: dict, digest: Optional[str] = None) -> None:
+        data = serialization.dumps(memory_data).decode("utf-8")
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO memories (user_id, data, backup_time, digest) VALUES (?, ?, ?, ?)",
+                (user_id, data, time.time(), digest)
+            )
+        self.bytes_written += len(data)
+
+    def memory_digest(self, user_id: int) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT digest FROM memories WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def load_memory(self, user_id: int) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data FROM memories WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return serialization.loads(row[0]) if row else None
+
+    def delete_memory(self, user_id: int) -> bool:
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM memories WHERE user_id = ?", (user_id,))
+        return cursor.rowcount > 0
+
+    # ----- 其他 -----
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._connection()
+        chat_count = conn.execute("SELECT COUNT(*) FROM chat_users").fetchone()[0]
+        memory_count = conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+        total_users = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT user_id FROM chat_users UNION SELECT user_id FROM memories)"
+        ).fetchone()[0]
+        latest_backup = conn.execute(
+            "SELECT MAX(backup_time) FROM (SELECT MAX(backup_time) AS backup_time FROM chat_users "
+            "UNION ALL SELECT MAX(backup_time) FROM memories)"
+        ).fetchone()[0]
+        return {
+            "chat_backup_count": chat_count,
+            "memory_backup_count": memory_count,
+            "total_users": total_users,
+            "memory_count": memory_count,
+            "latest_backup": latest_backup
+        }
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def _chat_log_user(filename: str) -> Optional[int]:
+    """chat_log_{user_id}.jsonl[.gz|.zst] -> user_id；不是聊天日誌時回傳 None"""
+    name = backup_compression.strip_suffix(filename)
+    if name.startswith('chat_log_') and name.endswith('.jsonl'):
+        try:
+            return int(name[len('chat_log_'):-len('.jsonl')])
+        except ValueError:
+            return None
+    return None
+
+
+def _chat_file_user(filename: str) -> Optional[int]:
+    """聊天日誌或舊版聊天備份檔名 -> user_id（分片搬移用）"""
+    user_id = _chat_log_user(filename)
+    if user_id is None and filename.startswith('chat_backup_') and filename.endswith('.json'):
+        try:
+            user_id = int(filename.split('_')[2])
+        except (IndexError, ValueError):
+            return None
+    return user_id
+
+
+def _memory_user(filename: str) -> Optional[int]:
+    """memory_{user_id}.json[.gz|.zst] -> user_id"""
+    name = backup_compression.strip_suffix(filename)
+    if name.startswith('memory_') and name.endswith('.json'):
+        try:
+            return int(name[len('memory_'):-len('.json')])
+        except ValueError:
+            return None
+    return None
+
+
+def _message_timestamp(message: Any) -> int:
+    if isinstance(message, MessageRecord):
+        return message.timestamp
+    return parse_timestamp(message.get("timestamp"))
+
+
+def create_backend(backup_directory: str, memory_directory: str,
+                   backend: Optional[str] = None) -> StorageBackend:
+    """依名稱（或環境變數 BACKUP_BACKEND）建立存儲後端，預設為 json"""
+    backend = (backend or os.getenv("BACKUP_BACKEND", "json")).lower()
+    if backend == "sqlite":
+        database_path = os.getenv("BACKUP_DATABASE", os.path.join(backup_directory, "backup.db"))
+        return SqliteStorageBackend(database_path)
+    if backend == "json":
+        # 壓縮方式由環境變數 BACKUP_COMPRESSION 決定（none / gzip / zstd）
+        return JsonStorageBackend(backup_directory, memory_directory)
+    raise ValueError(f"未知的備份後端: {backend}")
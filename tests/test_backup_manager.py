@@ -0,0 +1,99 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import chat_backup_manager
+from chat_backup_manager import BackupManager
+from message_record import MessageRecord
+from storage_backends import JsonStorageBackend, SqliteStorageBackend
+
+USER_COUNT = 1500
+
+
+def _manager(tmp_path, backend):
+    chat_dir, memory_dir = str(tmp_path / "chat"), str(tmp_path / "memory")
+    if backend == "sqlite":
+        storage = SqliteStorageBackend(str(tmp_path / "backup.db"))
+    else:
+        storage = JsonStorageBackend(chat_dir, memory_dir)
+    manager = BackupManager(chat_dir, memory_dir, storage=storage)
+    manager.snapshots = None
+    return manager
+
+
+def _record_writes(manager, monkeypatch) -> tuple:
+    """記下每位用戶寫完的時間，以及工作執行緒每次持有存儲鎖的寫入單位（一位用戶或一批交易）花了多久"""
+    finished, durations = [], []
+
+    save_chat = manager._save_chat_snapshot
+
+    def timed_save(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return save_chat(*args, **kwargs)
+        finally:
+            finished.append(time.monotonic())
+            durations.append(finished[-1] - started)
+
+    chunk_batch = manager._chunk_batch
+
+    @contextmanager
+    def timed_batch(throttle):
+        with chunk_batch(throttle):
+            started = time.monotonic()
+            try:
+                yield
+            finally:
+                durations.append(time.monotonic() - started)
+
+    monkeypatch.setattr(manager, "_save_chat_snapshot", timed_save)
+    monkeypatch.setattr(manager, "_chunk_batch", timed_batch)
+    return finished, durations
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_clear_during_backup_waits_for_one_write_at_most(tmp_path, monkeypatch, backend):
+    """整批備份進行中在事件循環上清除用戶：最多等一個寫入單位，清除也不會遺失
+
+    寫入單位在 JSON 是一位用戶，SQLite 是一批 BACKUP_BATCH_SIZE 位用戶的交易。
+    """
+    manager = _manager(tmp_path, backend)
+    unit_size = chat_backup_manager.BACKUP_BATCH_SIZE if backend == "sqlite" else 1
+    storage = manager.storage
+    user_ids = range(1, USER_COUNT + 1)
+    target = USER_COUNT // 2
+
+    async def scenario():
+        history = {user_id: [MessageRecord(f"訊息 {user_id}-1", "user", 1)] for user_id in user_ids}
+        for user_id in user_ids:
+            manager.mark_chat_dirty(user_id)
+        await manager.perform_backup(history, None)
+        assert storage.load_chat(target, 10)
+
+        # 每位用戶都有新訊息，第二輪整批寫入；寫到一半時在事件循環上清除 target
+        for user_id in user_ids:
+            history[user_id].append(MessageRecord(f"訊息 {user_id}-2", "user", 2))
+            manager.mark_chat_dirty(user_id)
+        written = storage.bytes_written
+        task = asyncio.create_task(manager.perform_backup(history, None))
+        while storage.bytes_written == written:
+            await asyncio.sleep(0.001)
+
+        started = time.monotonic()
+        manager.delete_old_chat_backups(target)
+        ended = time.monotonic()
+        await task
+        return started, ended
+
+    try:
+        finished, durations = _record_writes(manager, monkeypatch)
+        started, ended = asyncio.run(scenario())
+        # 事件循環等待期間，工作執行緒最多寫完一個寫入單位
+        assert sum(started < at < ended for at in finished) <= unit_size
+        assert ended - started < max(durations) + 0.1
+        assert storage.load_chat(target, 10) is None
+        assert len(storage.load_chat(target + 1, 10)) == 2
+    finally:
+        manager.close()
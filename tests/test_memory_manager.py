@@ -0,0 +1,54 @@
+import asyncio
+import importlib
+
+import memory_manager
+from chat_backup_manager import BackupManager
+from memory_manager import JoyMemoryManager
+
+
+def _memory_manager(tmp_path, manager_class=JoyMemoryManager):
+    backup_manager = BackupManager(str(tmp_path / "chat"), str(tmp_path / "memory"))
+    backup_manager.snapshots = None
+    return backup_manager, manager_class(str(tmp_path / "memory"), backup_manager)
+
+
+def test_cleared_summary_does_not_come_back_after_evict_and_reload(tmp_path):
+    backup_manager, manager = _memory_manager(tmp_path)
+    user_id = 42
+    try:
+        manager.add_message(user_id, "我的名字是小智", "user")
+        manager.conversation_summaries[user_id] = "舊的對話摘要"
+        manager.save_all_memories()
+
+        manager.clear_user_memory(user_id)
+        manager.add_message(user_id, "重新開始", "user")
+
+        assert asyncio.run(manager.evict_idle_users(0)) == [user_id]
+        assert user_id not in manager.short_term_memory
+
+        manager.add_message(user_id, "又回來了", "user")
+        assert not manager.conversation_summaries.get(user_id)
+        assert [msg.content for msg in manager.short_term_memory[user_id]] == ["重新開始", "又回來了"]
+    finally:
+        backup_manager.close()
+
+
+def test_profile_created_at_survives_restart(tmp_path):
+    backup_manager, manager = _memory_manager(tmp_path)
+    user_id = 42
+    try:
+        manager.add_message(user_id, "早安", "user")
+        manager.save_all_memories()
+        created_at = manager.user_profiles[user_id]["created_at"]
+    finally:
+        backup_manager.close()
+
+    # 重新載入模組，模擬重新啟動
+    restarted = importlib.reload(memory_manager).JoyMemoryManager
+    backup_manager, manager = _memory_manager(tmp_path, restarted)
+    try:
+        manager.add_message(user_id, "我回來了", "user")
+        assert manager.user_profiles[user_id]["created_at"] == created_at
+        assert manager.get_memory_stats(user_id)["profile_items"] == 0
+    finally:
+        backup_manager.close()
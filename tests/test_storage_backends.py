@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from storage_backends import JsonStorageBackend
+
+
+class Crash(Exception):
+    pass
+
+
+def _crash_on_manifest_update(backend, monkeypatch):
+    def set_chat(*args, **kwargs):
+        raise Crash()
+    monkeypatch.setattr(backend.manifest, "set_chat", set_chat)
+
+
+def _messages(*contents):
+    return [{"content": content, "sender": "user", "timestamp": index}
+            for index, content in enumerate(contents, 1)]
+
+
+def test_crash_before_manifest_update_keeps_rewritten_history(tmp_path, monkeypatch):
+    """整檔重寫日誌後、更新索引前當機：重新開啟時仍讀得到重寫後的日誌，下次保存不會蓋掉歷史"""
+    chat_dir, memory_dir = str(tmp_path / "chat"), str(tmp_path / "memory")
+    backend = JsonStorageBackend(chat_dir, memory_dir)
+    user_id = 42
+
+    # 只有舊版備份的用戶，第一次保存時整檔重寫成日誌並刪除舊檔
+    legacy_path = backend._chat_path(user_id, f"chat_backup_{user_id}_20240101_120000_000000.json")
+    os.makedirs(os.path.dirname(legacy_path), exist_ok=True)
+    with open(legacy_path, "w", encoding="utf-8") as f:
+        f.write('[{"content": "舊訊息", "sender": "user", "timestamp": 1}]')
+    backend.manifest.rebuild()
+    assert backend.load_chat(user_id, 10)[0]["content"] == "舊訊息"
+
+    _crash_on_manifest_update(backend, monkeypatch)
+    with pytest.raises(Crash):
+        backend.replace_chat(user_id, _messages("舊訊息", "新訊息"))
+
+    restarted = JsonStorageBackend(chat_dir, memory_dir)
+    assert [m["content"] for m in restarted.load_chat(user_id, 10)] == ["舊訊息", "新訊息"]
+    assert restarted.append_chat(user_id, _messages("第三則"))
+    assert [m["content"] for m in restarted.load_chat(user_id, 10)] == ["舊訊息", "新訊息", "第三則"]
+
+
+def test_crash_before_manifest_update_keeps_new_user(tmp_path, monkeypatch):
+    chat_dir, memory_dir = str(tmp_path / "chat"), str(tmp_path / "memory")
+    backend = JsonStorageBackend(chat_dir, memory_dir)
+
+    _crash_on_manifest_update(backend, monkeypatch)
+    with pytest.raises(Crash):
+        backend.replace_chat(7, _messages("第一則"))
+
+    restarted = JsonStorageBackend(chat_dir, memory_dir)
+    assert [m["content"] for m in restarted.load_chat(7, 10)] == ["第一則"]
+    assert 7 in restarted.manifest.chats
+
+
+def test_manifest_pointing_at_deleted_file_is_repaired(tmp_path):
+    chat_dir, memory_dir = str(tmp_path / "chat"), str(tmp_path / "memory")
+    backend = JsonStorageBackend(chat_dir, memory_dir)
+    backend.replace_chat(7, _messages("第一則"))
+
+    # 索引仍指向舊檔名，但磁碟上只剩新日誌
+    entry = backend.manifest.chats[7]
+    backend.manifest.set_chat(7, entry["time"], "chat_log_7.jsonl.gz")
+
+    restarted = JsonStorageBackend(chat_dir, memory_dir)
+    assert [m["content"] for m in restarted.load_chat(7, 10)] == ["第一則"]
+    assert restarted.manifest.chats[7]["file"] == "chat_log_7.jsonl"